@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# Times dbadmin commands against the local mock REST server and reports the
+# number of REST requests per command and p50/p99 latency.
+
+import sys, os, getopt, io, time, contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dbadmin
+from mock_server import MockCluster, startServer
+
+USER = 'admin@example.com'
+PASSWORD = 'admin'
+report_headers = ['Command', 'Runs', 'Requests/cmd', 'p50 ms', 'p99 ms']
+
+class LineBuffer:
+    # Replaces readline for SimpleCompleter so completion can be timed
+    # without a terminal.
+
+    def __init__(self):
+        self.line = ''
+
+    def get_line_buffer(self):
+        return self.line
+
+    def get_begidx(self):
+        idx = self.line.rfind(' ')
+        return idx + 1
+
+class Benchmark:
+
+    def __init__(self, cluster, port, runs):
+        self.cluster = cluster
+        self.port = port
+        self.runs = runs
+        self.results = []
+
+    def connect(self):
+        return dbadmin.HttpConnector('localhost', self.port, USER, PASSWORD)
+
+    def measure(self, name, fn, runs=None):
+        runs = runs or self.runs
+        samples = []
+        before = self.cluster.requests
+        for i in range(runs):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn(i)
+            samples.append((time.perf_counter() - start) * 1000)
+        requests = (self.cluster.requests - before) / float(runs)
+        samples.sort()
+        self.results.append([name, str(runs), '%.1f' % requests,
+                             '%.2f' % dbadmin.percentile(samples, 50), '%.2f' % dbadmin.percentile(samples, 99)])
+
+    def startup(self, i):
+        # What the interactive shell does before showing the prompt.
+        conn = self.connect()
+        admin = dbadmin.DBAdmin(conn, load_cluster=False)
+        admin.bootstrap()
+        conn.close()
+
+    def startupIndexed(self, i):
+        conn = self.connect()
+        admin = dbadmin.DBAdmin(conn, load_cluster=False)
+        admin.bootstrap()
+        admin.waitForIndex()
+        conn.close()
+
+    def run(self):
+        self.measure('startup', self.startup)
+        self.measure('startup + index', self.startupIndexed)
+
+        conn = self.connect()
+        admin = dbadmin.DBAdmin(conn)
+        admin.dbNameToUid()
+        shell = dbadmin.DBAdminShell(admin)
+
+        self.measure('list db', lambda i: shell.execCommand(['list', 'db']))
+        self.measure('list shards', lambda i: shell.execCommand(['list', 'shards']))
+        self.measure('list db <name>', lambda i: shell.execCommand(['list', 'db', 'db-1']))
+        self.measure('create', lambda i: shell.execCommand(['create', 'bench-' + str(i), 'memory', '2']))
+        self.measure('change', lambda i: shell.execCommand(['change', 'bench-' + str(i), 'memory', '3',
+                                                           'eviction', 'allkeys-lru']))
+        self.measure('delete', lambda i: shell.execCommand(['delete', 'bench-' + str(i)]))
+
+        buffer = LineBuffer()
+        saved = dbadmin.readline
+        dbadmin.readline = buffer
+        try:
+            completer = dbadmin.SimpleCompleter(admin)
+
+            def complete(i):
+                buffer.line = 'change db-1'
+                state = 0
+                while completer.complete('db-1', state) is not None:
+                    state += 1
+            self.measure('complete', complete)
+        finally:
+            dbadmin.readline = saved
+
+        opened, reused = conn.connectionStats()
+        conn.close()
+        dbadmin.printTable(self.results, report_headers)
+        print('Connections opened: ' + str(opened) + ', reused: ' + str(reused))
+
+USAGE = "benchmark [--dbs <count>] [--shards <shards per db>] [--latency <milliseconds>] [--runs <count>]"
+
+def main(argv):
+    dbs = 100
+    shards = 2
+    latency = 0
+    runs = 20
+    try:
+        opts, args = getopt.getopt(argv, '', ['dbs=', 'shards=', 'latency=', 'runs='])
+        for opt, arg in opts:
+            if opt == '--dbs':
+                dbs = int(arg)
+            elif opt == '--shards':
+                shards = int(arg)
+            elif opt == '--latency':
+                latency = float(arg) / 1000
+            elif opt == '--runs':
+                runs = int(arg)
+    except (getopt.GetoptError, ValueError):
+        print(USAGE)
+        sys.exit(2)
+
+    cluster = MockCluster(dbs, shards)
+    server = startServer(cluster, latency=latency, user=USER, password=PASSWORD)
+    print('Mock cluster: ' + str(dbs) + ' databases, ' + str(len(cluster.shards)) + ' shards, '
+          + str(latency * 1000) + 'ms latency')
+    Benchmark(cluster, server.server_port, runs).run()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+
+# A local stand-in for the Redis Enterprise REST API, used by benchmark.py.
+# It serves the endpoints dbadmin talks to over HTTPS from in-memory state
+# and can add a fixed latency to every request.
+
+import sys, getopt, json, re, ssl, threading, time, os, tempfile, subprocess, base64, random, collections
+
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GIGABYTE = 1024 * 1024 * 1024
+SLOTS = 16384
+
+class MockCluster:
+
+    def __init__(self, dbs=10, shards_per_db=2, nodes=3, rack_aware=False, activation=0):
+        self.lock = threading.Lock()
+        self.rack_aware = rack_aware
+        # Databases created through the API stay pending this many seconds.
+        self.activation = activation
+        self.activating = dict()
+        self.nodes = []
+        for i in range(1, nodes + 1):
+            self.nodes.append({'uid': i, 'addr': '10.0.0.' + str(i), 'status': 'active',
+                               'rack_id': 'rack-' + str(i) if rack_aware else '',
+                               'total_memory': 64 * GIGABYTE, 'shard_count': 0})
+        self.dbs = dict()
+        self.shards = dict()
+        self.next_db = 1
+        self.next_shard = 1
+        self.requests = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.events = collections.deque(maxlen=10000)
+        for i in range(dbs):
+            self.createDB({'name': 'db-' + str(i + 1), 'shards_count': shards_per_db})
+        self.activating.clear()
+
+    def makeShards(self, db):
+        for uid in [s['uid'] for s in self.shards.values() if s['bdb_uid'] == db['uid']]:
+            del self.shards[uid]
+        count = db['shards_count']
+        roles = ['master', 'slave'] if db['replication'] else ['master']
+        for i in range(count):
+            first = i * SLOTS // count
+            last = (i + 1) * SLOTS // count - 1
+            for n in range(len(roles)):
+                shard = {'uid': self.next_shard, 'bdb_uid': db['uid'],
+                         'node_uid': self.nodes[(self.next_shard + n) % len(self.nodes)]['uid'],
+                         'assigned_slots': str(first) + '-' + str(last), 'role': roles[n],
+                         'status': 'active'}
+                self.shards[shard['uid']] = shard
+                self.next_shard += 1
+
+    def createDB(self, spec):
+        uid = self.next_db
+        self.next_db += 1
+        db = {'uid': uid, 'name': 'db-' + str(uid), 'type': 'redis', 'status': 'active',
+              'memory_size': GIGABYTE, 'shards_count': 1, 'replication': False,
+              'rack_aware': False, 'bigstore': False, 'bigstore_ram_size': 0,
+              'data_persistence': 'disabled', 'eviction_policy': 'volatile-lru',
+              'sync': 'disabled', 'sync_sources': [], 'authentication_admin_pass': 'secret' + str(uid),
+              'authentication_redis_pass': ''}
+        db.update(spec)
+        db['uid'] = uid
+        port = spec.get('port', 0) or 12000 + uid
+        db['port'] = port
+        db['endpoints'] = [{'dns_name': 'redis-' + str(port) + '.cluster.local', 'addr': ['10.0.0.1'], 'port': port}]
+        self.dbs[uid] = db
+        self.makeShards(db)
+        self.logEvent('bdb_created', uid)
+        if self.activation > 0:
+            db['status'] = 'pending'
+            self.activating[uid] = time.time() + self.activation
+        return db
+
+    def activate(self):
+        now = time.time()
+        for uid, at in list(self.activating.items()):
+            if now >= at:
+                if uid in self.dbs:
+                    self.dbs[uid]['status'] = 'active'
+                del self.activating[uid]
+
+    def updateDB(self, uid, spec):
+        db = self.dbs[uid]
+        reshard = 'shards_count' in spec or 'replication' in spec
+        db.update(spec)
+        self.logEvent('bdb_updated', uid)
+        for source in db['sync_sources']:
+            source.setdefault('status', 'in-sync')
+        if reshard:
+            self.makeShards(db)
+        return db
+
+    def dbStats(self):
+        # Synthetic bdbs/stats/last values, roughly proportional to the size
+        # of each database.
+        stats = dict()
+        for uid, db in self.dbs.items():
+            ops = random.randint(0, 2000) * db['shards_count']
+            hits = int(ops * random.uniform(0.6, 0.99))
+            stats[str(uid)] = {'instantaneous_ops_per_sec': ops, 'read_hits': hits, 'read_misses': ops - hits,
+                               'write_hits': 0, 'write_misses': 0,
+                               'used_memory': int(db['memory_size'] * random.uniform(0.05, 0.9)),
+                               'avg_latency': random.uniform(50, 400)}
+        return stats
+
+    def shardStats(self):
+        stats = dict()
+        for uid, shard in self.shards.items():
+            ops = random.randint(0, 1000)
+            stats[str(uid)] = {'instantaneous_ops_per_sec': ops, 'read_hits': int(ops * 0.9),
+                               'read_misses': ops - int(ops * 0.9), 'write_hits': 0, 'write_misses': 0,
+                               'used_memory': random.randint(1, 512) * 1024 * 1024,
+                               'avg_latency': random.uniform(50, 400)}
+        return stats
+
+    def logEvent(self, type, uid):
+        # Times have one second resolution like the cluster's, so several
+        # events can share a time.
+        self.events.append({'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'type': type,
+                            'severity': 'INFO', 'bdb_uid': str(uid)})
+
+    def logs(self, query):
+        stime = query.get('stime', [''])[0]
+        events = [e for e in self.events if e['time'] >= stime]
+        if query.get('order', ['asc'])[0] == 'desc':
+            events.reverse()
+        limit = int(query.get('limit', ['0'])[0])
+        return events[:limit] if limit > 0 else events
+
+    def deleteDB(self, uid):
+        self.logEvent('bdb_deleted', uid)
+        del self.dbs[uid]
+        for s in [s['uid'] for s in self.shards.values() if s['bdb_uid'] == uid]:
+            del self.shards[s]
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment so responses do not stall on
+    # delayed ACKs.
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return dict()
+        return json.loads(self.rfile.read(length))
+
+    def authorized(self):
+        expected = self.server.auth
+        if expected is None:
+            return True
+        return self.headers.get('Authorization', '') == expected
+
+    def handle_request(self, method):
+        cluster = self.server.cluster
+        with cluster.lock:
+            cluster.requests += 1
+            busy = self.server.max_in_flight > 0 and cluster.in_flight >= self.server.max_in_flight
+            if busy:
+                cluster.rejected += 1
+            else:
+                cluster.in_flight += 1
+        if busy:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            return self.reply(503, {'error': 'too many requests in flight'})
+        try:
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+            return self.serve(cluster, method)
+        finally:
+            with cluster.lock:
+                cluster.in_flight -= 1
+
+    def serve(self, cluster, method):
+        if not self.authorized():
+            return self.reply(401, {'error': 'unauthorized'})
+        path = self.path.split('?')[0]
+        self.query = parse_qs(self.path.split('?', 1)[1]) if '?' in self.path else dict()
+        if not path.startswith('/v1/'):
+            return self.reply(404)
+        path = path[4:].rstrip('/')
+        try:
+            body = self.readBody() if method in ('POST', 'PUT') else None
+        except ValueError:
+            return self.reply(400, {'error': 'invalid json'})
+        with cluster.lock:
+            return self.route(cluster, method, path, body)
+
+    def route(self, cluster, method, path, body):
+        cluster.activate()
+        if method == 'GET' and path == 'cluster':
+            return self.reply(200, {'name': 'mock.cluster.local', 'rack_aware': cluster.rack_aware})
+        if method == 'GET' and path == 'nodes':
+            return self.reply(200, cluster.nodes)
+        if method == 'GET' and path == 'shards':
+            return self.reply(200, list(cluster.shards.values()))
+        if method == 'GET' and path == 'logs':
+            return self.reply(200, cluster.logs(self.query))
+        if method == 'GET' and path == 'actions':
+            return self.reply(200, [])
+        if method == 'GET' and path == 'shards/stats/last':
+            return self.reply(200, cluster.shardStats())
+        if method == 'GET' and path == 'bdbs/stats/last':
+            return self.reply(200, cluster.dbStats())
+        if path == 'bdbs':
+            if method == 'GET':
+                return self.reply(200, list(cluster.dbs.values()))
+            if method == 'POST':
+                for db in cluster.dbs.values():
+                    if db['name'] == body.get('name'):
+                        return self.reply(409, {'error': 'name already exists'})
+                return self.reply(200, cluster.createDB(body))
+        m = re.match(r'^bdbs/([0-9]+)(/shards)?$', path)
+        if m is None:
+            return self.reply(404)
+        uid = int(m.group(1))
+        if uid not in cluster.dbs:
+            return self.reply(404, {'error': 'database not found'})
+        if m.group(2) is not None:
+            if method == 'GET':
+                return self.reply(200, [s for s in cluster.shards.values() if s['bdb_uid'] == uid])
+            return self.reply(405)
+        if method == 'GET':
+            return self.reply(200, cluster.dbs[uid])
+        if method == 'PUT':
+            return self.reply(200, cluster.updateDB(uid, body))
+        if method == 'DELETE':
+            cluster.deleteDB(uid)
+            return self.reply(200)
+        return self.reply(405)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+def makeCertificate():
+    # A throwaway self-signed certificate; dbadmin does not verify it.
+    folder = tempfile.mkdtemp(prefix='dbadmin-mock-')
+    cert = os.path.join(folder, 'cert.pem')
+    key = os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def startServer(cluster, host='localhost', port=0, latency=0, user=None, password=None, cert=None, key=None,
+                max_in_flight=0):
+    # Starts the server on a background thread and returns it; server.server_port
+    # holds the bound port when port is 0. With max_in_flight, requests beyond
+    # that many at once are answered with 503 like an overloaded cluster.
+    if cert is None:
+        cert, key = makeCertificate()
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.cluster = cluster
+    server.latency = latency
+    server.max_in_flight = max_in_flight
+    server.auth = None
+    if user is not None:
+        server.auth = 'Basic ' + base64.b64encode((user + ':' + password).encode()).decode()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+USAGE = ("mock_server [-h <host>] [-p <port>] [--dbs <count>] [--shards <shards per db>] [--nodes <count>]"
+         " [--latency <milliseconds>] [--max-in-flight <requests>] [--activation <seconds>] [--rack]"
+         " [--cert <file> --key <file>]")
+
+def main(argv):
+    host = 'localhost'
+    port = 9443
+    dbs = 10
+    shards = 2
+    nodes = 3
+    latency = 0
+    max_in_flight = 0
+    activation = 0
+    rack = False
+    cert = None
+    key = None
+    try:
+        opts, args = getopt.getopt(argv, 'h:p:', ['dbs=', 'shards=', 'nodes=', 'latency=', 'max-in-flight=',
+                                                  'activation=', 'rack', 'cert=', 'key='])
+        for opt, arg in opts:
+            if opt == '-h':
+                host = arg
+            elif opt == '-p':
+                port = int(arg)
+            elif opt == '--dbs':
+                dbs = int(arg)
+            elif opt == '--shards':
+                shards = int(arg)
+            elif opt == '--nodes':
+                nodes = int(arg)
+            elif opt == '--latency':
+                latency = float(arg) / 1000
+            elif opt == '--max-in-flight':
+                max_in_flight = int(arg)
+            elif opt == '--activation':
+                activation = float(arg)
+            elif opt == '--rack':
+                rack = True
+            elif opt == '--cert':
+                cert = arg
+            elif opt == '--key':
+                key = arg
+    except (getopt.GetoptError, ValueError):
+        print(USAGE)
+        sys.exit(2)
+
+    server = startServer(MockCluster(dbs, shards, nodes, rack, activation), host, port, latency, cert=cert, key=key,
+                         max_in_flight=max_in_flight)
+    print('Serving ' + str(dbs) + ' databases on https://' + host + ':' + str(server.server_port) + '/v1/')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
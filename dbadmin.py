@@ -1,63 +1,93 @@
 #!/usr/bin/python3
 
-import sys, getopt, getpass, json, shlex, re
+import sys, os, getopt, getpass, json, shlex, re, time, io, threading, csv, itertools, collections, tempfile, bisect, array, math, random
+import socket, socketserver, signal, heapq, codecs, stat
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 import requests
 from requests.auth import HTTPBasicAuth
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-
-has_tabulate = False
-try:
-    from tabulate import tabulate
-    has_tabulate = True
-except ImportError:
-    has_tabulate = False
-try:
-    import readline
-except ImportError:
-    import pyreadline as readline
-
-def getfirst():
-    idx = readline.get_begidx()
-    full = readline.get_line_buffer()
-    tokens = full[:idx].split()
-    if len(tokens) > 0:
-        return tokens[0]
-    else:
-        return ''
-    
-def getlast():
-    idx = readline.get_begidx()
-    full = readline.get_line_buffer()
-    tokens = full[:idx].split()
-    if len(tokens) > 0:
-        return tokens[-1]
-    else:
-        return ''
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning, NewConnectionError
+from requests.packages.urllib3.connection import HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+
+# tabulate and readline are only imported when a table is first printed or
+# the interactive shell starts, so one-shot commands do not pay for them.
+has_tabulate = None
+tabulate = None
+readline = None
+
+def loadTabulate():
+    global has_tabulate, tabulate
+    try:
+        from tabulate import tabulate
+        has_tabulate = True
+    except ImportError:
+        has_tabulate = False
+
+def loadReadline():
+    global readline
+    try:
+        import readline
+    except ImportError:
+        import pyreadline as readline
+
+completion_modes = ['prefix', 'substring', 'fuzzy']
 
-def gettokens():
-    idx = readline.get_begidx()
-    full = readline.get_line_buffer()
-    tokens = full[:idx].split()
-    return tokens
+class CompletionIndex:
+    # Sorted database names and uids built from the name index, so prefix
+    # completion is a binary search instead of a scan of every database.
 
-def getparmnum():
-    return len(gettokens())
+    def __init__(self, name_to_uid):
+        self.uid_of = dict((name, str(uid)) for name, uid in name_to_uid.items())
+        self.name_of = dict((uid, name) for name, uid in self.uid_of.items())
+        self.names = sorted(self.uid_of.keys())
+        self.keys = sorted(self.names + list(self.name_of.keys()))
 
-def getparam(idx):
-    return gettokens()[idx]
+    def contains(self, token):
+        return token in self.uid_of or token in self.name_of
+
+    def related(self, token):
+        # The name and the uid of the database given by either of them.
+        if token in self.uid_of:
+            return set([token, self.uid_of[token]])
+        if token in self.name_of:
+            return set([token, self.name_of[token]])
+        return set([token])
+
+    def find(self, text, mode='prefix'):
+        if mode == 'substring':
+            return [k for k in self.keys if text in k]
+        elif mode == 'fuzzy':
+            return [k for k in self.keys if CompletionIndex.isSubsequence(text, k)]
+        lo = bisect.bisect_left(self.keys, text)
+        hi = bisect.bisect_left(self.keys, text + '\uffff', lo)
+        return self.keys[lo:hi]
+
+    @staticmethod
+    def isSubsequence(text, key):
+        pos = 0
+        for c in text:
+            pos = key.find(c, pos) + 1
+            if pos == 0:
+                return False
+        return True
 
 class SimpleCompleter(object):
     
-    def __init__(self, admin):
+    def __init__(self, admin, mode='prefix'):
         self.dbadmin = admin
+        self.mode = mode
         self.command = ''
         self.db = ''
+        self.last_key = None
+        self.matches = []
         self.create_options = DBAdmin.create_options
         self.change_options = DBAdmin.change_options
         if self.dbadmin.isRackAware():
-            self.create_options += ['rack']
-            self.change_options += ['rack']
+            self.create_options = self.create_options + ['rack']
+            self.change_options = self.change_options + ['rack']
 
     def getOptions(self, text, options, ignore=[]):
         options = [i for i in options if i not in ignore]
@@ -67,59 +97,104 @@ class SimpleCompleter(object):
             self.matches = options[:]
             
     def getDBsOptions(self, text, ignore=''):
-        dbs = self.dbadmin.getDBs(ignore)
-        names = int(len(dbs) / 2)
+        index = self.dbadmin.getCompletionIndex()
         if text == '':
-            self.getOptions(text, dbs[:names])
+            matches = index.names
         else:
-            self.getOptions(text, dbs)
+            matches = index.find(text, self.mode)
+        if ignore != '':
+            ignored = index.related(ignore)
+            matches = [m for m in matches if m not in ignored]
+        self.matches = matches
 
     def complete(self, text, state):
-        response = None
-        # This is the first time for this text, so build a match list.
-        
-        self.command = getfirst()
-        last = getlast()
+        # readline asks for one match per call with an increasing state, so
+        # the match list is only rebuilt when the line or the index changed.
+        line = readline.get_line_buffer()
+        idx = readline.get_begidx()
+        key = (line, idx, text, self.dbadmin.index_version)
+        if key != self.last_key:
+            self.last_key = key
+            self.buildMatches(text, line[:idx].split())
+        # Return the state'th item from the match list,
+        # if we have that many.
+        try:
+            response = self.matches[state]
+        except IndexError:
+            response = None
+        return response
+
+    def buildMatches(self, text, tokens):
+        self.command = tokens[0] if len(tokens) > 0 else ''
+        last = tokens[-1] if len(tokens) > 0 else ''
             
         if self.command == '':
             self.getOptions(text, DBAdminShell.commands)
+        elif self.command == 'analyze':
+            if last == self.command:
+                self.getOptions(text, DBAdmin.analyze_options)
+            else:
+                self.matches = []
         elif self.command == 'list':
             if last == self.command:
                 self.getOptions(text, DBAdmin.list_options)
-            elif last in self.dbadmin.getDBs():
+            elif last == 'nodes':
+                self.matches = []
+            elif self.dbadmin.getCompletionIndex().contains(last):
                 self.matches = []
             else:
                 self.getDBsOptions(text)
         elif self.command == 'create':
-            n = getparmnum()
+            n = len(tokens)
             if n == 1:
                 self.matches = []
             elif n == 2:
                 self.getOptions(text, self.create_options + ['json'])
-            elif 'json' in gettokens():
+            elif 'json' in tokens:
                 self.matches = []
             elif last == 'replication' or last == 'rack':
-                self.getOptions(text, self.create_options, gettokens()[2:])
+                self.getOptions(text, self.create_options, tokens[2:])
             elif last == 'persist':
                     self.getOptions(text, DBAdmin.persist_options)
             elif last == 'eviction':
                     self.getOptions(text, DBAdmin.eviction_options)
             elif last not in self.create_options:
-                self.getOptions(text, self.create_options, gettokens()[2:])
+                self.getOptions(text, self.create_options, tokens[2:])
             else:
                 self.matches = []
+        elif self.command == 'top':
+            if last == 'sort':
+                self.getOptions(text, DBTop.sort_columns)
+            elif last in DBAdmin.top_options:
+                self.matches = []
+            else:
+                self.getOptions(text, DBAdmin.top_options)
+        elif self.command == 'tail':
+            if last == 'db':
+                self.getDBsOptions(text)
+            elif last in DBAdmin.tail_options:
+                self.matches = []
+            else:
+                self.getOptions(text, DBAdmin.tail_options)
+        elif self.command == 'collect':
+            if last in DBAdmin.collect_options:
+                self.matches = []
+            else:
+                self.getOptions(text, DBAdmin.collect_options)
         elif self.command == 'delete':
             if last == self.command:
                 self.getDBsOptions(text)
             else:
                 self.matches = []
         elif self.command == 'change':
+            if len(tokens) > 1:
+                self.db = tokens[1]
             if last == self.command:
                 self.getDBsOptions(text)
-            elif last in self.dbadmin.getDBs():
+            elif self.dbadmin.getCompletionIndex().contains(last):
                 self.db = last
                 self.getOptions(text, self.change_options + ['json'])
-            elif 'json' in gettokens()[2:]:
+            elif 'json' in tokens[2:]:
                 self.matches = []
             elif last in self.change_options:
                 self.subcommand = last
@@ -145,36 +220,519 @@ class SimpleCompleter(object):
                     
         else:
             self.matches = []
-        # Return the state'th item from the match list,
-        # if we have that many.
-        try:
-            response = self.matches[state]
-        except IndexError:
-            response = None
-        return response
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
+connect_timer = threading.local()
+
+class TimedHTTPSConnection(HTTPSConnection):
+    # Adds the time spent in TCP connect and the TLS handshake to the
+    # calling thread's connect_timer, so the request can be charged for it.
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super(TimedHTTPSConnection, self).connect()
+        finally:
+            connect_timer.elapsed = getattr(connect_timer, 'elapsed', 0) + time.perf_counter() - start
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+def endpointTemplate(param):
+    return re.sub(r'/[0-9]+(?=/|$)', '/{uid}', param.split('?')[0])
+
+def percentile(ordered, p):
+    # Nearest rank percentile of an already sorted sequence.
+    if len(ordered) == 0:
+        return 0
+    idx = max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)
+    return ordered[idx]
+
+class RequestRecorder:
+    # Keeps per endpoint counters and the most recent latencies of every
+    # request made by an HttpConnector, and optionally appends each record
+    # to a jsonl trace file.
+    max_samples = 10000
+    histogram_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    report_headers = ['Method', 'Endpoint', 'Count', 'Errors', 'KB', 'Connect ms', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms']
+
+    def __init__(self, trace_file=None):
+        self.lock = threading.Lock()
+        self.endpoints = collections.OrderedDict()
+        self.samples = collections.deque(maxlen=RequestRecorder.max_samples)
+        self.trace = None
+        if trace_file is not None:
+            self.trace = open(trace_file, 'a')
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def record(self, method, param, status, size, connect, total):
+        key = (method, endpointTemplate(param))
+        with self.lock:
+            entry = self.endpoints.get(key)
+            if entry is None:
+                entry = {'count': 0, 'errors': 0, 'bytes': 0, 'connect': 0.0,
+                         'times': collections.deque(maxlen=RequestRecorder.max_samples)}
+                self.endpoints[key] = entry
+            entry['count'] += 1
+            if status != requests.codes.ok:
+                entry['errors'] += 1
+            entry['bytes'] += size
+            entry['connect'] += connect
+            entry['times'].append(total)
+            self.samples.append(total)
+            if self.trace is not None:
+                self.trace.write(json.dumps({'time': time.time(), 'method': method, 'endpoint': key[1],
+                                             'path': param, 'status': status, 'bytes': size,
+                                             'connect_ms': round(connect * 1000, 3),
+                                             'total_ms': round(total * 1000, 3)}) + '\n')
+                self.trace.flush()
+
+    def printReport(self):
+        with self.lock:
+            items = [(k, dict(v, times=sorted(v['times']))) for k, v in self.endpoints.items()]
+            samples = list(self.samples)
+        if len(items) == 0:
+            print('No requests recorded')
+            return
+        rows = []
+        for key, entry in items:
+            times = entry['times']
+            rows.append([key[0], key[1], str(entry['count']), str(entry['errors']),
+                         '%.1f' % (entry['bytes'] / 1024.0), '%.1f' % (entry['connect'] * 1000),
+                         '%.1f' % (percentile(times, 50) * 1000),
+                         '%.1f' % (percentile(times, 95) * 1000),
+                         '%.1f' % (percentile(times, 99) * 1000),
+                         '%.1f' % (times[-1] * 1000 if len(times) > 0 else 0)])
+        printTable(rows, RequestRecorder.report_headers)
+        self.printHistogram(samples)
+
+    def printHistogram(self, samples):
+        buckets = RequestRecorder.histogram_buckets
+        counts = [0] * (len(buckets) + 1)
+        for t in samples:
+            ms = t * 1000
+            i = 0
+            while i < len(buckets) and ms >= buckets[i]:
+                i += 1
+            counts[i] += 1
+        top = max(counts)
+        used = [i for i in range(len(counts)) if counts[i] > 0]
+        print('Latency histogram:')
+        for i in range(used[0] if used else 0, used[-1] + 1 if used else 0):
+            if i < len(buckets):
+                label = '< ' + str(buckets[i]) + ' ms'
+            else:
+                label = '>= ' + str(buckets[-1]) + ' ms'
+            bar = '#' * int(round(40.0 * counts[i] / top)) if top > 0 else ''
+            print(label.rjust(11) + ' ' + str(counts[i]).rjust(6) + ' ' + bar)
+        print("")
+
+class CommandDeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+class ConcurrencyLimiter:
+    # AIMD limit on the requests in flight across all threads. Every request
+    # that completes fast and without an overload status raises the limit by
+    # 1/limit, about one per round of requests; an overload status, a timeout
+    # or a latency far above the best seen halves it (slow requests take off
+    # 10%), at most once per round trip so one burst of errors counts once.
+    latency_factor = 4
+    latency_floor = 1.0
+
+    def __init__(self, max_limit):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(max(1, max_limit // 2))
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, deadline=None):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            if not overloaded and (self.min_latency is None or latency < self.min_latency):
+                self.min_latency = latency
+            slow = (self.min_latency is not None and latency > self.latency_floor
+                    and latency > self.latency_factor * self.min_latency)
+            now = time.time()
+            if overloaded or slow:
+                if now - self.last_decrease > latency:
+                    self.limit = max(1.0, self.limit / 2 if overloaded else self.limit * 0.9)
+                    self.last_decrease = now
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+def connectFailed(error):
+    # True when the request never reached the node, so it is safe to send it
+    # again elsewhere whatever its method.
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and len(error.args) > 0:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+class NodeSelector:
+    # The cluster nodes that can serve the REST API, with a moving average of
+    # their probe latency. Requests go to the current node; it changes when
+    # it fails or another healthy node is clearly faster.
+    switch_margin = 0.8
+
+    def __init__(self, host):
+        self.hosts = [host]
+        self.latency = dict()
+        self.down = dict()
+        self.current = host
+        self.lock = threading.Lock()
+
+    def add(self, hosts):
+        with self.lock:
+            for host in hosts:
+                if host not in self.hosts:
+                    self.hosts.append(host)
+
+    def record(self, host, latency):
+        with self.lock:
+            self.down.pop(host, None)
+            old = self.latency.get(host)
+            self.latency[host] = latency if old is None else 0.7 * old + 0.3 * latency
+
+    def markDown(self, host):
+        with self.lock:
+            self.down[host] = time.time()
+
+    def healthy(self):
+        return [h for h in self.hosts if h not in self.down]
+
+    def choose(self):
+        # Moves to the fastest healthy node, unless the current one is
+        # healthy and within the margin of it.
+        with self.lock:
+            measured = [h for h in self.healthy() if h in self.latency]
+            if len(measured) == 0:
+                return self.current
+            best = min(measured, key=lambda h: self.latency[h])
+            current = self.latency.get(self.current)
+            if self.current in self.down or current is None or self.latency[best] < NodeSelector.switch_margin * current:
+                self.current = best
+            return self.current
+
+    def failover(self, host):
+        # Marks host down and moves to another healthy node, the fastest known
+        # first. Returns False when there is none left.
+        with self.lock:
+            self.down[host] = time.time()
+            if self.current != host:
+                return True
+            candidates = self.healthy()
+            if len(candidates) == 0:
+                return False
+            self.current = min(candidates, key=lambda h: self.latency.get(h, float('inf')))
+            return True
+
 class HttpConnector():
+    connect_timeout = 10
+    read_timeout = 120
+    max_retries = 5
+    backoff_base = 0.5
+    backoff_max = 10
+    retry_methods = ['GET', 'PUT', 'DELETE']
+    retry_statuses = [409, 429, 503]
+    probe_interval = 30
+    probe_delay = 1
+    probe_timeout = 2
+    stream_chunk = 64 * 1024
 
-    def __init__(self, host, port, user, password):
-        self.url = "https://" + host + ":" + str(port) + "/v1/"
+    def __init__(self, host, port, user, password, pool_size=10, timeout=None, recorder=None,
+                 connect_timeout=None, deadline=0, retries=None):
+        self.port = port
+        self.nodes = NodeSelector(host)
+        self.probe_thread = None
+        self.probe_stop = threading.Event()
         self.auth=HTTPBasicAuth(user, password)
-    
-    def get(self, param):
-        url = self.url + param 
-        resp = requests.get(url, verify=False, auth=self.auth)
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout if connect_timeout is not None else HttpConnector.connect_timeout,
+                        timeout if timeout is not None else HttpConnector.read_timeout)
+        self.deadline = deadline
+        self.retries = retries if retries is not None else HttpConnector.max_retries
+        self.retried = 0
+        self.limiter = ConcurrencyLimiter(pool_size)
+        self.local = threading.local()
+        self.recorder = recorder if recorder is not None else RequestRecorder()
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {'https': TimedHTTPSConnectionPool}
+        self.session.mount('https://', adapter)
+        self.adapter = adapter
+
+    def urlFor(self, host):
+        return "https://" + host + ":" + str(self.port) + "/v1/"
+
+    def close(self):
+        self.probe_stop.set()
+        self.session.close()
+        self.recorder.close()
+
+    def discoverNodes(self):
+        # Every active node serves the REST API on the same port.
+        resp = self.get('nodes', quiet=True)
+        if resp is None:
+            return False
+        self.nodes.add([n['addr'] for n in resp if n.get('addr') and n.get('status', 'active') == 'active'])
+        return True
+
+    def probeNodes(self):
+        # Probes use their own session so they neither wait for the limiter
+        # nor show up in the request statistics. The first round waits
+        # probe_delay, so one-shot commands that are done by then never probe.
+        session = requests.Session()
+        session.auth = self.auth
+        try:
+            self.probe_stop.wait(HttpConnector.probe_delay)
+            while not self.probe_stop.is_set():
+                for host in list(self.nodes.hosts):
+                    if self.probe_stop.is_set():
+                        return
+                    start = time.perf_counter()
+                    try:
+                        resp = session.get(self.urlFor(host) + 'cluster', verify=False, timeout=HttpConnector.probe_timeout)
+                        # Anything but a 200 (wrong credentials, not a cluster
+                        # node, overloaded) makes the node unfit to serve.
+                        if resp.status_code == requests.codes.ok:
+                            self.nodes.record(host, time.perf_counter() - start)
+                        else:
+                            self.nodes.markDown(host)
+                    except requests.exceptions.RequestException:
+                        self.nodes.markDown(host)
+                self.nodes.choose()
+                self.probe_stop.wait(HttpConnector.probe_interval)
+        finally:
+            session.close()
+
+    def startProbes(self):
+        if self.probe_thread is None:
+            self.probe_thread = threading.Thread(target=self.probeNodes)
+            self.probe_thread.daemon = True
+            self.probe_thread.start()
+
+    def startCommand(self):
+        # Starts the deadline of a command on the calling thread.
+        self.local.deadline = time.time() + self.deadline if self.deadline > 0 else None
+
+    def getDeadline(self):
+        return getattr(self.local, 'deadline', None)
+
+    def setDeadline(self, deadline):
+        # Worker threads of a command share the deadline of the command.
+        self.local.deadline = deadline
+
+    def sendOnce(self, method, host, param, data, headers, timeout, stream=False):
+        connect_timer.elapsed = 0
+        start = time.perf_counter()
+        status = 0
+        size = 0
+        streamed = False
+        try:
+            resp = self.session.request(method, self.urlFor(host) + param, data=data, headers=headers,
+                                        verify=False, timeout=timeout, stream=stream)
+            status = resp.status_code
+            if stream and status == requests.codes.ok:
+                # Recorded by iterArray once the body has been read.
+                streamed = True
+            else:
+                size = len(resp.content)
+        finally:
+            if not streamed:
+                self.recorder.record(method, param, status, size, connect_timer.elapsed, time.perf_counter() - start)
+        return resp
+
+    def backoff(self, attempt, resp):
+        delay = random.uniform(0, min(HttpConnector.backoff_max, HttpConnector.backoff_base * 2 ** attempt))
+        if resp is not None:
+            try:
+                delay = max(delay, float(resp.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def send(self, method, param, data=None, stream=False):
+        # Requests wait for a slot of the concurrency limiter. When a node
+        # cannot be reached, or an idempotent request to it fails or times
+        # out, it is sent again right away to another node. Idempotent ones
+        # are retried with jittered exponential backoff on 409, 429 and 503
+        # and on connection errors or timeouts, until the retries or the
+        # command deadline run out.
+        headers = None
+        if data is not None:
+            headers = {'Content-Type': 'application/json'}
+        deadline = self.getDeadline()
+        attempt = 0
+        failovers = 0
+        while True:
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise CommandDeadlineExceeded('Command deadline of ' + str(self.deadline) + 's exceeded')
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+            if not self.limiter.acquire(deadline):
+                raise CommandDeadlineExceeded('Command deadline of ' + str(self.deadline) + 's exceeded')
+            start = time.perf_counter()
+            host = self.nodes.current
+            resp = None
+            error = None
+            try:
+                resp = self.sendOnce(method, host, param, data, headers, timeout, stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            finally:
+                overloaded = resp is None or resp.status_code in HttpConnector.retry_statuses
+                self.limiter.release(time.perf_counter() - start, overloaded)
+            if (error is not None and (method in HttpConnector.retry_methods or connectFailed(error))
+                    and failovers < len(self.nodes.hosts) - 1 and self.nodes.failover(host)):
+                failovers += 1
+                continue
+            if not overloaded or method not in HttpConnector.retry_methods or attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return resp
+            delay = self.backoff(attempt, resp)
+            if deadline is not None and time.time() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return resp
+            attempt += 1
+            self.retried += 1
+            if resp is not None:
+                resp.close()
+            time.sleep(delay)
+
+    def connectionStats(self):
+        # urllib3 counts every request sent through a pool and every new
+        # connection it had to open; the difference was served by a kept-alive one.
+        opened = 0
+        sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, sent - opened
+
+    def get(self, param, quiet=False):
+        resp = self.send('GET', param)
         if resp.status_code != requests.codes.ok:
-            print("Error: " + resp.reason + ", " + str(resp.status_code))
+            if not quiet:
+                print("Error: " + resp.reason + ", " + str(resp.status_code))
             return None
         else:
             return resp.json()
 
+    def stream(self, param, quiet=False):
+        # Like get, for endpoints that return a json array: returns an
+        # iterator over the elements, decoded one at a time as the body is
+        # read from the socket, or None when the request failed.
+        start = time.perf_counter()
+        resp = self.send('GET', param, stream=True)
+        if resp.status_code != requests.codes.ok:
+            if not quiet:
+                print("Error: " + resp.reason + ", " + str(resp.status_code))
+            return None
+        return self.iterArray(resp, param, connect_timer.elapsed, start)
+
+    def iterArray(self, resp, param, connect, start):
+        # Only the unparsed tail of the body is buffered: elements are taken
+        # off the front of the buffer with raw_decode, and a chunk is read
+        # whenever the next element is not complete yet.
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+        chunks = resp.iter_content(HttpConnector.stream_chunk)
+        buf = ''
+        pos = 0
+        size = 0
+        eof = False
+        state = 'open'
+        try:
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                need_more = pos >= len(buf)
+                if not need_more:
+                    c = buf[pos]
+                    if state == 'done':
+                        raise ValueError('Unexpected data after the json array from ' + param)
+                    elif state == 'open':
+                        if c != '[':
+                            raise ValueError('Expected a json array from ' + param)
+                        pos += 1
+                        state = 'first'
+                    elif state == 'next':
+                        if c == ',':
+                            pos += 1
+                            state = 'item'
+                        elif c == ']':
+                            pos += 1
+                            state = 'done'
+                        else:
+                            raise ValueError('Invalid json array from ' + param)
+                    elif state == 'first' and c == ']':
+                        pos += 1
+                        state = 'done'
+                    else:
+                        try:
+                            element, end = decoder.raw_decode(buf, pos)
+                        except ValueError:
+                            if eof:
+                                raise
+                            end = None
+                        # A value that reaches the end of the buffer, or a number
+                        # cut short by it ("2." of "2.5"), may continue in the
+                        # next chunk.
+                        if end is None or not eof and (end >= len(buf) or buf[pos] not in '{["'
+                                                       and buf[end] in '0123456789.eE+-'):
+                            need_more = True
+                        else:
+                            pos = end
+                            state = 'next'
+                            yield element
+                if need_more:
+                    # After the closing bracket, only whitespace may follow
+                    # up to the end of the body.
+                    if eof and state == 'done':
+                        return
+                    if eof:
+                        raise ValueError('Truncated json array from ' + param)
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        eof = True
+                        chunk = b''
+                    size += len(chunk)
+                    buf = buf[pos:] + text.decode(chunk, eof)
+                    pos = 0
+        finally:
+            resp.close()
+            self.recorder.record('GET', param, resp.status_code, size, connect, time.perf_counter() - start)
+
     def post(self, param, data):
-        url = self.url + param
-        headers={'Content-Type': 'application/json'}
-        resp = requests.post(url, data=data, headers=headers, verify=False, auth=self.auth)
+        resp = self.send('POST', param, data)
         if resp.status_code != requests.codes.ok:
             print("Error: " + resp.reason + ", " + str(resp.status_code))
         else:
@@ -183,26 +741,92 @@ class HttpConnector():
        
     
     def delete(self, param):
-        url = self.url + param 
-        resp = requests.delete(url, verify=False, auth=self.auth)
+        resp = self.send('DELETE', param)
         if resp.status_code != requests.codes.ok:
             print("Error: " + resp.reason + ", " + str(resp.status_code))
+            return False
         else:
             print("OK")
+            return True
             
     def put(self, param, data):
-        url = self.url + param
-        headers={'Content-Type': 'application/json'}
-        resp = requests.put(url, data=data, headers=headers, verify=False, auth=self.auth)
+        resp = self.send('PUT', param, data)
         if resp.status_code != requests.codes.ok:
             print("Error: " + resp.reason + ", " + str(resp.status_code))
         else:
             print("OK")
+            if len(resp.content) == 0:
+                return dict()
+            return resp.json()
 
+stats_report_headers = ['Kind', 'Uid', 'Metric', 'Samples', 'Min', 'Max', 'Mean', 'p95', 'p99']
 db_headers = ['Uid', 'Name', 'Dns name', 'IP Address', 'Port', 'Shards', 'Memory', 'Persistence', 'Flags']
 shard_headers = ['Uid', 'DB Uid', 'Node Uid', 'Assigned Slots', 'Role']
 GIGABYTE = 1024 * 1024 * 1024
    
+spec_fields = ['memory_size', 'bigstore', 'bigstore_ram_size', 'shards_count', 'replication', 'rack_aware',
+               'data_persistence', 'aof_policy', 'snapshot_policy', 'eviction_policy', 'sync_sources']
+plan_headers = ['Uid', 'Name', 'Field', 'Current', 'Planned']
+
+def maskSources(sources):
+    # Sync source uris carry the source's admin password, which plan output
+    # must not show.
+    return [{'uri': re.sub(r'^(rediss?://[^:@/]*:)[^@/]*@', r'\1***@', s['uri'])} for s in sources]
+
+def dbToSpec(db):
+    # The fields create and change manage, as they appear in the REST API.
+    # Policies that do not apply to the current settings are left out.
+    spec = {'name': db['name']}
+    for field in spec_fields:
+        if field not in db:
+            continue
+        if field == 'bigstore_ram_size' and not db.get('bigstore'):
+            continue
+        if field == 'aof_policy' and db.get('data_persistence') != 'aof':
+            continue
+        if field == 'snapshot_policy' and db.get('data_persistence') != 'snapshot':
+            continue
+        if field == 'sync_sources':
+            spec[field] = [{'uri': s['uri']} for s in db[field]]
+        else:
+            spec[field] = db[field]
+    return spec
+
+def specDiff(spec, db):
+    # Only the fields listed in the spec are compared, so a spec may manage a
+    # subset of them.
+    changes = dict()
+    for field in spec_fields:
+        if field not in spec:
+            continue
+        current = db.get(field)
+        if field == 'sync_sources' and current is not None:
+            current = [{'uri': s['uri']} for s in current]
+        if spec[field] != current:
+            changes[field] = spec[field]
+    return changes
+
+def dbSelector(expr):
+    # Parses "<field>=<value>", "<field>!=<value>" or "<field>~<regex>" into a
+    # predicate on a bdbs document. Non string fields compare by their json text.
+    m = re.match(r'^(\w+)(!=|=|~)(.*)$', expr)
+    if m is None:
+        return None
+    field, op, value = m.groups()
+
+    def text(db):
+        v = db.get(field)
+        return v if isinstance(v, str) else json.dumps(v)
+    if op == '~':
+        try:
+            pattern = re.compile(value)
+        except re.error:
+            return None
+        return lambda db: pattern.search(text(db)) is not None
+    elif op == '=':
+        return lambda db: text(db) == value
+    return lambda db: text(db) != value
+
 def dbToRow(db):
     row = []
     options = ''
@@ -257,7 +881,238 @@ def shardToRow(shard):
     row.append(shard['role'])
     return row
     
+class RecordStore:
+    # Column store for listings: numeric columns are typed arrays and text
+    # columns lists of interned strings, so repeated names, roles and
+    # addresses are stored once. A row is an index into the columns.
+    # Queries run in one pass over the rows and only the printed rows are
+    # turned back into records for formatting.
+    query_words = ['where', 'sort', 'group', 'limit']
+    # The operator is the first one after the column name, so values may
+    # contain operator characters themselves.
+    condition = re.compile(r'^(\w+)(!=|<=|>=|=|<|>|~)(.*)$')
+
+    def __init__(self, columns, sums=None):
+        # columns is a list of (name, extractor, numeric); sums lists the
+        # (column, header, scale) totals shown by group by.
+        self.names = [c[0] for c in columns]
+        self.extractors = [c[1] for c in columns]
+        self.numeric = [c[2] for c in columns]
+        self.columns = [array.array('q') if c[2] else [] for c in columns]
+        self.sums = sums or []
+        self.count = 0
+
+    def append(self, obj):
+        for i in range(len(self.columns)):
+            value = self.extractors[i](obj)
+            self.columns[i].append(int(value) if self.numeric[i] else sys.intern(str(value)))
+        self.count += 1
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+        return self
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def record(self, row):
+        return dict((self.names[i], self.columns[i][row]) for i in range(len(self.columns)))
+
+    @staticmethod
+    def parseNumber(name, text):
+        # Numbers may end with K, M or G (binary units), e.g. memory_size>=2G.
+        m = re.match(r'^(-?[0-9]+(?:\.[0-9]+)?)([KMG]?)$', text.upper())
+        if m is None:
+            raise ValueError('Illegal ' + name + ': ' + text + '. Must be a number, optionally ending with K, M or G')
+        return float(m.group(1)) * {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': GIGABYTE}[m.group(2)]
+
+    def parseCondition(self, expr):
+        m = RecordStore.condition.match(expr)
+        if m is None:
+            raise ValueError('Illegal condition: ' + expr)
+        name, op, value = m.groups()
+        if name not in self.names:
+            raise ValueError('Unknown column: ' + name + ', must be one of: ' + ' '.join(self.names))
+        col = self.column(name)
+        if op == '~':
+            pattern = re.compile(value)
+            return lambda row: pattern.search(str(col[row])) is not None
+        if self.numeric[self.names.index(name)]:
+            value = RecordStore.parseNumber(name, value)
+        compare = {'=': lambda a, b: a == b, '!=': lambda a, b: a != b, '<': lambda a, b: a < b,
+                   '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}[op]
+        return lambda row: compare(col[row], value)
+
+    def parseQuery(self, params):
+        # where <col><op><value> (repeatable), sort <col>|count [desc], group by <col>, limit <n>
+        query = {'where': [], 'sort': None, 'desc': False, 'group': None, 'limit': 0}
+        while len(params) > 0:
+            p = params[0]
+            if p == 'where' and len(params) > 1:
+                query['where'].append(self.parseCondition(params[1]))
+                params = params[2:]
+            elif p == 'sort' and len(params) > 1:
+                if params[1] not in self.names + ['count']:
+                    raise ValueError('Unknown column: ' + params[1] + ', must be one of: ' + ' '.join(self.names))
+                query['sort'] = params[1]
+                params = params[2:]
+                if len(params) > 0 and params[0] in ['asc', 'desc']:
+                    query['desc'] = params[0] == 'desc'
+                    params = params[1:]
+            elif p == 'group' and len(params) > 2 and params[1] == 'by':
+                if params[2] not in self.names:
+                    raise ValueError('Unknown column: ' + params[2] + ', must be one of: ' + ' '.join(self.names))
+                query['group'] = params[2]
+                params = params[3:]
+            elif p == 'limit' and len(params) > 1:
+                query['limit'] = int(params[1])
+                params = params[2:]
+            else:
+                raise ValueError('Illegal query: ' + ' '.join(params))
+        if query['sort'] == 'count' and query['group'] is None:
+            raise ValueError('sort count needs group by')
+        if query['group'] is not None and query['sort'] not in [None, 'count', query['group']]:
+            raise ValueError('With group by, sort must be count or ' + query['group'])
+        return query
+
+    def select(self, query):
+        # Matching row indexes: filtered, sorted and limited in one pass. With
+        # a limit, sorting keeps only the top rows in a heap.
+        conditions = query['where']
+        rows = (r for r in range(self.count) if all(c(r) for c in conditions))
+        limit = query['limit']
+        if query['sort'] is not None:
+            col = self.column(query['sort'])
+            if limit > 0:
+                pick = heapq.nlargest if query['desc'] else heapq.nsmallest
+                return pick(limit, rows, key=lambda r: col[r])
+            return sorted(rows, key=lambda r: col[r], reverse=query['desc'])
+        if limit > 0:
+            return list(itertools.islice(rows, limit))
+        return rows
+
+    def group(self, query):
+        # Count and totals per value of the group column, in one pass.
+        col = self.column(query['group'])
+        sums = [(self.column(name), scale) for name, header, scale in self.sums]
+        groups = dict()
+        for r in (r for r in range(self.count) if all(c(r) for c in query['where'])):
+            totals = groups.get(col[r])
+            if totals is None:
+                totals = [0] * (1 + len(sums))
+                groups[col[r]] = totals
+            totals[0] += 1
+            for i in range(len(sums)):
+                totals[i + 1] += sums[i][0][r]
+        # Groups are in key order unless sorted by count.
+        keys = sorted(groups.keys())
+        if query['sort'] == 'count':
+            keys.sort(key=lambda k: groups[k][0], reverse=query['desc'])
+        elif query['desc']:
+            keys.reverse()
+        if query['limit'] > 0:
+            keys = keys[:query['limit']]
+        headers = [query['group'], 'Count'] + [header for name, header, scale in self.sums]
+        rows = []
+        for key in keys:
+            totals = groups[key]
+            rows.append([str(key), str(totals[0])] + ['%g' % (totals[i + 1] / float(sums[i][1]))
+                                                       for i in range(len(sums))])
+        return rows, headers
+
+def firstEndpoint(db, field, default):
+    endpoints = db.get('endpoints', [])
+    if len(endpoints) == 0:
+        return default
+    if field == 'addr':
+        addr = endpoints[0].get('addr', [])
+        return addr[0] if len(addr) > 0 else ''
+    return endpoints[0].get(field, default)
+
+db_columns = [('uid', lambda db: db['uid'], True),
+              ('name', lambda db: db['name'], False),
+              ('dns_name', lambda db: firstEndpoint(db, 'dns_name', ''), False),
+              ('addr', lambda db: firstEndpoint(db, 'addr', ''), False),
+              ('port', lambda db: firstEndpoint(db, 'port', -1), True),
+              ('shards_count', lambda db: db['shards_count'], True),
+              ('replication', lambda db: db['replication'] == True, True),
+              ('memory_size', lambda db: db['memory_size'], True),
+              ('bigstore', lambda db: db['bigstore'] == True, True),
+              ('bigstore_ram_size', lambda db: db.get('bigstore_ram_size', 0) or 0, True),
+              ('data_persistence', lambda db: db['data_persistence'], False),
+              ('sync_sources', lambda db: len(db['sync_sources']), True),
+              ('rack_aware', lambda db: db['rack_aware'] == True, True)]
+db_sums = [('shards_count', 'Shards', 1), ('memory_size', 'Memory GB', GIGABYTE)]
+shard_columns = [('uid', lambda s: s['uid'], True),
+                 ('bdb_uid', lambda s: s['bdb_uid'], True),
+                 ('node_uid', lambda s: s['node_uid'], True),
+                 ('assigned_slots', lambda s: s['assigned_slots'], False),
+                 ('role', lambda s: s['role'], False)]
+
+def dbRecordToRow(record):
+    # Rebuilds the fields dbToRow reads from a RecordStore record.
+    db = dict(record)
+    db['replication'] = record['replication'] == 1
+    db['bigstore'] = record['bigstore'] == 1
+    db['rack_aware'] = record['rack_aware'] == 1
+    db['sync_sources'] = [None] * record['sync_sources']
+    db['endpoints'] = []
+    if record['port'] >= 0:
+        db['endpoints'] = [{'dns_name': record['dns_name'], 'port': record['port'],
+                            'addr': [record['addr']] if record['addr'] != '' else []}]
+    return dbToRow(db)
+
+output_formats = ['table', 'jsonl', 'csv', 'tsv']
+
+def formatParam(params, default):
+    # Strips "--format <format>" from command parameters; returns None, None
+    # for a missing or unknown format.
+    if '--format' not in params:
+        return params, default
+    idx = params.index('--format')
+    if idx + 1 >= len(params) or params[idx + 1] not in output_formats:
+        print('Illegal format, must be one of: ' + ' '.join(output_formats))
+        return None, None
+    return params[:idx] + params[idx + 2:], params[idx + 1]
+
+def printRows(rows, headers, fmt='table', lookahead=0):
+    # rows may be any iterable; every format except a full table prints
+    # each row as soon as it is produced.
+    if fmt == 'jsonl':
+        for row in rows:
+            print(json.dumps(dict(zip(headers, row))))
+    elif fmt == 'csv' or fmt == 'tsv':
+        writer = csv.writer(sys.stdout, delimiter=',' if fmt == 'csv' else '\t', lineterminator='\n')
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+    elif lookahead > 0:
+        printTableStreaming(rows, headers, lookahead)
+    else:
+        printTable(list(rows), headers)
+
+def printTableStreaming(rows, headers, lookahead):
+    # Column widths are measured on the first lookahead rows only; a wider
+    # value further down is printed in full and pushes its line out.
+    rows = iter(rows)
+    head = list(itertools.islice(rows, lookahead))
+    column_width = []
+    for i in range(len(headers)):
+        width = len(headers[i])
+        for row in head:
+            if len(row[i]) > width:
+                width = len(row[i])
+        column_width.append(width)
+    print(' '.join(headers[i].ljust(column_width[i]+1) for i in range(len(headers))))
+    print('  '.join('-' * column_width[i] for i in range(len(headers))))
+    for row in itertools.chain(head, rows):
+        print(' '.join(row[i].ljust(column_width[i]+1) for i in range(len(headers))))
+    print("")
+
 def printTable(rows, headers):
+    if has_tabulate is None:
+        loadTabulate()
     if has_tabulate:
         print(tabulate(rows, headers, tablefmt='simple'))
     else:
@@ -283,10 +1138,796 @@ def printTable(rows, headers):
         print("")
     
 
+class OutputRouter(object):
+    # Stands in for sys.stdout so that each worker thread can collect the
+    # output of the command it runs; other threads write straight through.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, buffer=None):
+        self.local.buffer = buffer if buffer is not None else io.StringIO()
+
+    def release(self):
+        buf = self.local.buffer
+        self.local.buffer = None
+        return buf.getvalue()
+
+    def write(self, text):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is not None:
+            return buf.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is not None:
+            return buf.flush()
+        self.stream.flush()
+
+    def isatty(self):
+        if getattr(self.local, 'buffer', None) is not None:
+            return False
+        return self.stream.isatty()
+
+class MetadataCache:
+    # Per cluster file with the rack_aware flag, the name/uid index and the
+    # node addresses, so a new process can resolve names and complete without
+    # fetching bdbs, and fail over to another node.
+    # Files are replaced atomically and ignored once the index they hold is
+    # older than ttl.
+    version = 1
+
+    def __init__(self, host, port, ttl=3600, folder=None):
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.dbadmin', 'cache')
+        self.folder = folder
+        self.path = os.path.join(folder, re.sub(r'[^A-Za-z0-9.-]', '_', host) + '_' + str(port) + '.json')
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('v') != MetadataCache.version or time.time() - entry.get('t', 0) >= self.ttl:
+            return None
+        return entry
+
+    def save(self, rack_aware, index, nodes=None, synced=None):
+        entry = {'v': MetadataCache.version, 't': synced if synced is not None else time.time(),
+                 'rack_aware': rack_aware, 'dbs': [[uid, name] for name, uid in index], 'nodes': nodes or []}
+        data = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            try:
+                if not os.path.isdir(self.folder):
+                    os.makedirs(self.folder, 0o700)
+                fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.tmp-')
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except (IOError, OSError):
+                pass
+
+class DBStatsWindow:
+    # Ring buffer of the last samples of one database. Hit and miss totals
+    # over the window are kept as running sums, so adding a sample costs the
+    # same however long the window is.
+
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, sample):
+        if len(self.samples) == self.samples.maxlen:
+            old = self.samples[0]
+            self.hits -= old['hits']
+            self.misses -= old['misses']
+        self.samples.append(sample)
+        self.hits += sample['hits']
+        self.misses += sample['misses']
+
+    def last(self):
+        return self.samples[-1]
+
+    def previous(self):
+        if len(self.samples) < 2:
+            return None
+        return self.samples[-2]
+
+    def hitRatio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return None
+        return 100.0 * self.hits / total
+
+class DBTop:
+    # Polls bdbs/stats/last, one request per tick for all databases, and
+    # redraws a table of throughput, hit ratio, memory and latency.
+    top_headers = ['Uid', 'Name', 'Ops/s', 'Delta ops', 'Hit %', 'Used MB', 'Mem %', 'Latency ms', 'Delta ms']
+    sort_columns = ['uid', 'name', 'ops', 'hit', 'memory', 'latency']
+    usage = 'top [sort ' + '|'.join(sort_columns) + '] [interval <seconds>] [count <refreshes>] [window <samples>]'
+
+    def __init__(self, admin, interval=2, window=30, sort='ops', count=0):
+        self.admin = admin
+        self.conn = admin.conn
+        self.interval = interval
+        self.window = window
+        self.sort = sort
+        self.count = count
+        self.windows = dict()
+        self.dbs = dict()
+
+    def loadDBs(self):
+        resp = self.conn.get('bdbs')
+        if resp is not None:
+            self.dbs = dict((db['uid'], db) for db in resp)
+
+    @staticmethod
+    def toSample(stats):
+        return {'ops': stats.get('instantaneous_ops_per_sec', stats.get('total_req', 0)) or 0,
+                'hits': (stats.get('read_hits', 0) or 0) + (stats.get('write_hits', 0) or 0),
+                'misses': (stats.get('read_misses', 0) or 0) + (stats.get('write_misses', 0) or 0),
+                'used_memory': stats.get('used_memory', 0) or 0,
+                'latency': (stats.get('avg_latency', 0) or 0) / 1000.0}
+
+    def sample(self):
+        resp = self.conn.get('bdbs/stats/last?interval=1sec')
+        if resp is None:
+            return False
+        if any(int(uid) not in self.dbs for uid in resp.keys()):
+            self.loadDBs()
+        for uid, stats in resp.items():
+            uid = int(uid)
+            window = self.windows.get(uid)
+            if window is None:
+                window = DBStatsWindow(self.window)
+                self.windows[uid] = window
+            window.add(DBTop.toSample(stats))
+        for uid in [u for u in self.windows.keys() if str(u) not in resp]:
+            del self.windows[uid]
+        return True
+
+    def toRow(self, uid):
+        window = self.windows[uid]
+        last = window.last()
+        prev = window.previous()
+        db = self.dbs.get(uid, {})
+        memory_size = db.get('memory_size', 0)
+        hit = window.hitRatio()
+        values = {'uid': uid, 'name': db.get('name', ''), 'ops': last['ops'],
+                  'hit': hit if hit is not None else -1, 'memory': last['used_memory'], 'latency': last['latency']}
+        row = [str(uid), values['name'], '%.0f' % last['ops'],
+               '%+.0f' % (last['ops'] - prev['ops']) if prev is not None else '',
+               '%.1f' % hit if hit is not None else '',
+               '%.1f' % (last['used_memory'] / 1024.0 / 1024.0),
+               '%.1f' % (100.0 * last['used_memory'] / memory_size) if memory_size > 0 else '',
+               '%.3f' % last['latency'],
+               '%+.3f' % (last['latency'] - prev['latency']) if prev is not None else '']
+        return values, row
+
+    def draw(self):
+        rows = [self.toRow(uid) for uid in self.windows.keys()]
+        rows.sort(key=lambda r: r[0][self.sort], reverse=self.sort not in ['uid', 'name'])
+        if sys.stdout.isatty():
+            print('\033[H\033[2J', end='')
+        print(time.strftime('%H:%M:%S') + '  ' + str(len(rows)) + ' databases, sorted by ' + self.sort
+              + ', every ' + str(self.interval) + 's')
+        printTable([r[1] for r in rows], DBTop.top_headers)
+
+    def run(self):
+        self.loadDBs()
+        n = 0
+        try:
+            while True:
+                if not self.sample():
+                    return False
+                self.draw()
+                n += 1
+                if self.count > 0 and n >= self.count:
+                    return True
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print('')
+            return True
+
+class StatsCollector:
+    # Samples bdbs/stats/last and shards/stats/last into column arrays and
+    # appends them to a csv file whenever flush_rows rows are buffered, so
+    # memory stays bounded however long it runs. With downsample N, every N
+    # samples of an entity are averaged into one row.
+    metrics = ['instantaneous_ops_per_sec', 'used_memory', 'avg_latency',
+               'read_hits', 'read_misses', 'write_hits', 'write_misses']
+    file_headers = ['time', 'kind', 'uid', 'bdb_uid'] + metrics
+
+    def __init__(self, conn, path, interval=10, downsample=1, flush_rows=4096):
+        self.conn = conn
+        self.path = path
+        self.interval = interval
+        self.downsample = max(1, downsample)
+        self.flush_rows = flush_rows
+        self.shard_db = dict()
+        self.pending = dict()
+        self.clear()
+
+    def clear(self):
+        self.times = array.array('d')
+        self.kinds = []
+        self.uids = array.array('l')
+        self.bdb_uids = array.array('l')
+        self.values = [array.array('d') for m in StatsCollector.metrics]
+
+    def loadShards(self):
+        resp = self.conn.get('shards')
+        if resp is not None:
+            self.shard_db = dict((s['uid'], s['bdb_uid']) for s in resp)
+
+    def add(self, now, kind, uid, bdb_uid, stats):
+        row = [float(stats[m]) if stats.get(m) is not None else float('nan') for m in StatsCollector.metrics]
+        if self.downsample > 1:
+            key = (kind, uid)
+            acc = self.pending.get(key)
+            if acc is None:
+                acc = [0, [0.0] * len(row)]
+                self.pending[key] = acc
+            acc[0] += 1
+            acc[1] = [acc[1][i] + row[i] for i in range(len(row))]
+            if acc[0] < self.downsample:
+                return
+            row = [v / acc[0] for v in acc[1]]
+            del self.pending[key]
+        self.times.append(now)
+        self.kinds.append(kind)
+        self.uids.append(uid)
+        self.bdb_uids.append(bdb_uid)
+        for i in range(len(row)):
+            self.values[i].append(row[i])
+
+    def sample(self):
+        now = time.time()
+        dbs = self.conn.get('bdbs/stats/last?interval=1sec')
+        shards = self.conn.get('shards/stats/last?interval=1sec')
+        if dbs is None and shards is None:
+            return False
+        for uid, stats in (dbs or {}).items():
+            self.add(now, 'bdb', int(uid), int(uid), stats)
+        if shards is not None and any(int(uid) not in self.shard_db for uid in shards.keys()):
+            self.loadShards()
+        for uid, stats in (shards or {}).items():
+            self.add(now, 'shard', int(uid), self.shard_db.get(int(uid), -1), stats)
+        if len(self.times) >= self.flush_rows:
+            self.flush()
+        return True
+
+    def flush(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            if new_file:
+                writer.writerow(StatsCollector.file_headers)
+            for r in range(len(self.times)):
+                writer.writerow(['%.3f' % self.times[r], self.kinds[r], self.uids[r], self.bdb_uids[r]]
+                                + ['' if math.isnan(c[r]) else '%.15g' % c[r] for c in self.values])
+        self.clear()
+
+    def run(self, duration=0):
+        self.loadShards()
+        end = time.time() + duration if duration > 0 else None
+        n = 0
+        try:
+            while end is None or time.time() < end:
+                start = time.time()
+                if not self.sample():
+                    break
+                n += 1
+                print('\rCollected ' + str(n) + ' samples', end='')
+                sys.stdout.flush()
+                time.sleep(max(0, self.interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            pass
+        self.flush()
+        print('\nSaved to ' + self.path)
+        return n > 0
+
+def statsReport(path, bdb_uid=None):
+    # One pass over the file fills an array per (kind, uid, metric); each
+    # array is then sorted once for its percentiles.
+    groups = collections.OrderedDict()
+    with open(path) as f:
+        reader = csv.reader(f)
+        headers = next(reader)
+        metrics = headers[4:]
+        for row in reader:
+            if bdb_uid is not None and int(row[3]) != bdb_uid:
+                continue
+            key = (row[1], int(row[2]))
+            columns = groups.get(key)
+            if columns is None:
+                columns = [array.array('d') for m in metrics]
+                groups[key] = columns
+            for i in range(len(metrics)):
+                if row[4 + i] != '':
+                    columns[i].append(float(row[4 + i]))
+    rows = []
+    for key, columns in groups.items():
+        for i in range(len(metrics)):
+            values = sorted(columns[i])
+            if len(values) == 0:
+                continue
+            rows.append([key[0], str(key[1]), metrics[i], str(len(values)), '%g' % values[0], '%g' % values[-1],
+                         '%g' % (sum(values) / len(values)), '%g' % percentile(values, 95),
+                         '%g' % percentile(values, 99)])
+    return rows
+
+class PlacementAnalysis:
+    # Joins nodes, shards and bdbs, fetched concurrently, through dicts keyed
+    # by uid. Everything is computed in one pass over the shards.
+    node_headers = ['Node Uid', 'Address', 'Rack', 'Status', 'Masters', 'Replicas', 'Shards', 'Assigned MB', 'Total MB']
+    colocated_headers = ['DB Uid', 'DB Name', 'Slots', 'Shared', 'Master Node', 'Replica Node']
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.nodes = None
+        self.shards = None
+        self.dbs = None
+
+    def fetchOne(self, param, deadline):
+        self.conn.setDeadline(deadline)
+        return self.conn.get(param)
+
+    def fetch(self):
+        deadline = self.conn.getDeadline()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(self.fetchOne, p, deadline) for p in ['nodes', 'shards', 'bdbs']]
+            self.nodes, self.shards, self.dbs = [f.result() for f in futures]
+        return self.nodes is not None and self.shards is not None and self.dbs is not None
+
+    def analyze(self):
+        nodes = collections.OrderedDict((n['uid'], n) for n in sorted(self.nodes, key=lambda n: n['uid']))
+        dbs = dict((db['uid'], db) for db in self.dbs)
+        self.load = dict((uid, [0, 0, 0]) for uid in nodes.keys())
+        ranges = dict()
+        for shard in self.shards:
+            node_uid = int(shard['node_uid'])
+            load = self.load.get(node_uid)
+            if load is None:
+                load = [0, 0, 0]
+                self.load[node_uid] = load
+            db = dbs.get(shard['bdb_uid'])
+            if db is not None:
+                load[2] += db.get('memory_size', 0) // max(1, db.get('shards_count', 1))
+            key = (shard['bdb_uid'], shard['assigned_slots'])
+            entry = ranges.get(key)
+            if entry is None:
+                entry = ([], [])
+                ranges[key] = entry
+            if shard['role'] == 'master':
+                load[0] += 1
+                entry[0].append(node_uid)
+            else:
+                load[1] += 1
+                entry[1].append(node_uid)
+        self.colocated = []
+        for key, (masters, replicas) in ranges.items():
+            for m in masters:
+                for r in replicas:
+                    rack = nodes[m].get('rack_id', '') if m in nodes else ''
+                    if m == r:
+                        shared = 'node'
+                    elif rack != '' and r in nodes and nodes[r].get('rack_id', '') == rack:
+                        shared = 'rack'
+                    else:
+                        continue
+                    db = dbs.get(key[0], {})
+                    self.colocated.append([str(key[0]), db.get('name', ''), key[1], shared, str(m), str(r)])
+        self.colocated.sort(key=lambda row: (int(row[0]), row[2]))
+        self.node_info = nodes
+
+    @staticmethod
+    def imbalance(values):
+        # How far the busiest node is above the average, 0 when balanced.
+        if len(values) == 0:
+            return 0.0
+        mean = float(sum(values)) / len(values)
+        if mean == 0:
+            return 0.0
+        return (max(values) - mean) / mean
+
+    def nodeRows(self):
+        for uid, load in sorted(self.load.items()):
+            node = self.node_info.get(uid, {})
+            yield [str(uid), node.get('addr', ''), node.get('rack_id', ''), node.get('status', ''),
+                   str(load[0]), str(load[1]), str(load[0] + load[1]), '%.0f' % (load[2] / 1024.0 / 1024.0),
+                   '%.0f' % (node.get('total_memory', 0) / 1024.0 / 1024.0)]
+
+    def scores(self):
+        loads = list(self.load.values())
+        return (PlacementAnalysis.imbalance([l[0] for l in loads]),
+                PlacementAnalysis.imbalance([l[0] + l[1] for l in loads]),
+                PlacementAnalysis.imbalance([l[2] for l in loads]))
+
+class ReplicaOfGraph:
+    # The replica of links of all databases, built from one bdbs response.
+    # Sync source uris are mapped back to databases through an index of every
+    # endpoint dns name and address.
+    link_headers = ['DB Uid', 'DB Name', 'Sync', 'Source Uid', 'Source Name', 'Source', 'Status', 'Flags']
+
+    def __init__(self, dbs):
+        self.dbs = collections.OrderedDict((db['uid'], db) for db in sorted(dbs, key=lambda db: db['uid']))
+        self.endpoints = dict()
+        for db in self.dbs.values():
+            for endpoint in db.get('endpoints', []):
+                port = str(endpoint.get('port', ''))
+                self.endpoints[endpoint.get('dns_name', '') + ':' + port] = db['uid']
+                for addr in endpoint.get('addr', []):
+                    self.endpoints[addr + ':' + port] = db['uid']
+        self.sources = dict()
+        for db in self.dbs.values():
+            self.sources[db['uid']] = [self.resolve(s['uri']) for s in db.get('sync_sources', [])]
+        self.in_cycle = self.findCycles()
+
+    @staticmethod
+    def endpointOf(uri):
+        m = re.match(r'^rediss?://(?:[^@/]*@)?([^:/@]+):([0-9]+)', uri)
+        if m is None:
+            return uri
+        return m.group(1) + ':' + m.group(2)
+
+    def resolve(self, uri):
+        return self.endpoints.get(ReplicaOfGraph.endpointOf(uri), -1)
+
+    def findCycles(self):
+        # Tarjan's strongly connected components, iteratively so long chains
+        # do not hit the recursion limit. A database is in a cycle when its
+        # component has more than one member or it replicates from itself.
+        index = dict()
+        low = dict()
+        stack = []
+        on_stack = set()
+        in_cycle = set()
+        counter = 0
+        for root in self.dbs.keys():
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while len(work) > 0:
+                uid, i = work.pop()
+                if i == 0:
+                    index[uid] = low[uid] = counter
+                    counter += 1
+                    stack.append(uid)
+                    on_stack.add(uid)
+                sources = [s for s in self.sources.get(uid, []) if s in self.dbs]
+                if i < len(sources):
+                    work.append((uid, i + 1))
+                    src = sources[i]
+                    if src not in index:
+                        work.append((src, 0))
+                    elif src in on_stack:
+                        low[uid] = min(low[uid], index[src])
+                    continue
+                if low[uid] == index[uid]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == uid:
+                            break
+                    if len(component) > 1 or uid in sources:
+                        in_cycle.update(component)
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[uid])
+        return in_cycle
+
+    def links(self, uid=None):
+        for db in self.dbs.values():
+            for source, src_uid in zip(db.get('sync_sources', []), self.sources[db['uid']]):
+                if uid is not None and uid not in [db['uid'], src_uid]:
+                    continue
+                yield db, source, src_uid
+
+    def toRow(self, db, source, src_uid):
+        flags = []
+        if src_uid < 0:
+            flags.append('missing')
+        elif db['uid'] in self.in_cycle and src_uid in self.in_cycle:
+            flags.append('cycle')
+        if source.get('last_error'):
+            flags.append(source['last_error'])
+        src = self.dbs.get(src_uid, {})
+        return [str(db['uid']), db['name'], db.get('sync', ''), str(src_uid) if src_uid >= 0 else '',
+                src.get('name', ''), ReplicaOfGraph.endpointOf(source['uri']), source.get('status', ''),
+                ', '.join(flags)]
+
+class LogTail:
+    # Follows the cluster event log. Each poll asks only for entries at or
+    # after the time of the newest one seen; the log has one second
+    # resolution, so entries at exactly that time are counted and skipped
+    # when they come back. Nothing else is kept between polls.
+    tail_headers = ['Time', 'Severity', 'Type', 'DB Uid', 'Details']
+    page_size = 1000
+
+    def __init__(self, conn, uid=None, interval=2, lines=20, count=0, fmt='table'):
+        self.conn = conn
+        self.uid = str(uid) if uid is not None else None
+        self.interval = interval
+        self.lines = lines
+        self.count = count
+        self.fmt = fmt
+        self.cursor = None
+        self.seen = collections.Counter()
+        self.header = False
+
+    @staticmethod
+    def entryKey(entry):
+        return json.dumps(entry, sort_keys=True)
+
+    def advance(self, entries):
+        # Returns the entries not seen before and moves the cursor past them.
+        fresh = []
+        skip = collections.Counter(self.seen)
+        for entry in entries:
+            t = entry.get('time', '')
+            key = LogTail.entryKey(entry)
+            if self.cursor is not None and t < self.cursor:
+                continue
+            if t == self.cursor and skip[key] > 0:
+                skip[key] -= 1
+                continue
+            if t != self.cursor:
+                self.cursor = t
+                self.seen = collections.Counter()
+                skip = collections.Counter()
+            self.seen[key] += 1
+            fresh.append(entry)
+        return fresh
+
+    def show(self, entries):
+        for entry in entries:
+            if self.uid is not None and str(entry.get('bdb_uid', '')) != self.uid:
+                continue
+            if self.fmt == 'jsonl':
+                print(json.dumps(entry))
+                continue
+            if not self.header:
+                print('%-20s  %-8s  %-28s  %-6s  %s' % tuple(LogTail.tail_headers))
+                self.header = True
+            details = ' '.join(k + '=' + str(v) for k, v in sorted(entry.items())
+                               if k not in ['time', 'severity', 'type', 'bdb_uid'])
+            print('%-20s  %-8s  %-28s  %-6s  %s' % (entry.get('time', ''), entry.get('severity', ''),
+                                                    entry.get('type', ''), entry.get('bdb_uid', ''), details))
+        sys.stdout.flush()
+
+    def seedCursor(self, window, limit):
+        # The newest entries fetched at start may be only some of those at
+        # the cursor time; all of them count as seen, or the first poll
+        # would print the older ones as new.
+        if len(window) < limit or window[0].get('time', '') != self.cursor:
+            return True
+        resp = self.conn.get('logs?order=asc&limit=' + str(LogTail.page_size) + '&stime=' + quote(self.cursor))
+        if resp is None:
+            return False
+        self.seen = collections.Counter(LogTail.entryKey(e) for e in resp if e.get('time', '') == self.cursor)
+        return True
+
+    def start(self):
+        if self.lines <= 0:
+            resp = self.conn.get('logs?order=desc&limit=1')
+            if resp is None:
+                return False
+            self.advance(resp)
+            return self.seedCursor(resp, 1)
+        # With a db filter, the last lines are taken from a bigger window.
+        limit = self.lines if self.uid is None else LogTail.page_size
+        resp = self.conn.get('logs?order=desc&limit=' + str(limit))
+        if resp is None:
+            return False
+        resp.reverse()
+        entries = self.advance(resp)
+        if not self.seedCursor(resp, limit):
+            return False
+        if self.uid is not None:
+            entries = [e for e in entries if str(e.get('bdb_uid', '')) == self.uid]
+        self.show(entries[-self.lines:])
+        return True
+
+    def poll(self):
+        while True:
+            param = 'logs?order=asc&limit=' + str(LogTail.page_size)
+            if self.cursor is not None:
+                param += '&stime=' + quote(self.cursor)
+            resp = self.conn.get(param)
+            if resp is None:
+                return False
+            fresh = self.advance(resp)
+            self.show(fresh)
+            # A full page with nothing new is one second holding more than a
+            # page of entries; it cannot be paged past by time.
+            if len(resp) < LogTail.page_size or len(fresh) == 0:
+                return True
+
+    def run(self):
+        if not self.start():
+            return False
+        n = 0
+        try:
+            while self.count <= 0 or n < self.count:
+                time.sleep(self.interval)
+                if not self.poll():
+                    return False
+                n += 1
+        except KeyboardInterrupt:
+            pass
+        return True
+
+class CompletionPoller(object):
+    # A single polling thread serves every caller waiting for a database,
+    # so many pending databases share one bdbs and one actions request per tick.
+    pending_actions = ['queued', 'starting', 'running', 'pending']
+    failed_status = ['creation-failed', 'delete-pending']
+
+    def __init__(self, conn, initial_delay=0.5, max_delay=10):
+        self.conn = conn
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.waiters = dict()
+        self.thread = None
+        self.reset = False
+
+    def watch(self, uid, timeout, callback=None):
+        # Registers a waiter without blocking; callback(state) is called on
+        # the polling thread once the database is ready, failed or timed out.
+        waiter = {'deadline': time.time() + timeout, 'state': None, 'done': threading.Event(), 'callback': callback}
+        with self.cond:
+            self.waiters.setdefault(uid, []).append(waiter)
+            self.reset = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.poll)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return waiter
+
+    def wait(self, uid, timeout):
+        waiter = self.watch(uid, timeout)
+        # The poller times waiters out itself; this only bounds a tick that
+        # is stuck in a request.
+        if not waiter['done'].wait(timeout + self.max_delay):
+            with self.cond:
+                remaining = [w for w in self.waiters.get(uid, []) if w is not waiter]
+                if len(remaining) > 0:
+                    self.waiters[uid] = remaining
+                else:
+                    self.waiters.pop(uid, None)
+            return 'timeout'
+        return waiter['state']
+
+    def finish(self, waiter):
+        waiter['done'].set()
+        if waiter['callback'] is not None:
+            waiter['callback'](waiter['state'])
+
+    def fetch(self, uids):
+        dbs = dict()
+        if len(uids) == 1:
+            uid = uids[0]
+            resp = self.conn.get('bdbs/' + str(uid), quiet=True)
+            if resp is not None:
+                dbs[uid] = resp
+        else:
+            resp = self.conn.get('bdbs', quiet=True)
+            if resp is None:
+                return None
+            for db in resp:
+                dbs[db['uid']] = db
+        return dbs
+
+    def busyDBs(self):
+        busy = set()
+        resp = self.conn.get('actions', quiet=True)
+        if resp is None:
+            return busy
+        if isinstance(resp, dict):
+            resp = resp.get('actions', [])
+        for action in resp:
+            obj = action.get('object_name', '')
+            if obj.startswith('bdb:') and action.get('status') in CompletionPoller.pending_actions:
+                try:
+                    busy.add(int(obj[4:]))
+                except ValueError:
+                    pass
+        return busy
+
+    def dbState(self, db, busy):
+        if db is None:
+            return 'database not found'
+        status = db.get('status', 'active')
+        if status in CompletionPoller.failed_status:
+            return status
+        if status != 'active' or db['uid'] in busy:
+            return None
+        if db.get('sync') == 'enabled':
+            for source in db.get('sync_sources', []):
+                if source.get('status') != 'in-sync':
+                    return None
+        return 'active'
+
+    def poll(self):
+        delay = self.initial_delay
+        try:
+            while True:
+                with self.cond:
+                    if len(self.waiters) == 0:
+                        self.thread = None
+                        return
+                    uids = list(self.waiters.keys())
+                    self.reset = False
+                try:
+                    dbs = self.fetch(uids)
+                    busy = self.busyDBs()
+                except (requests.exceptions.RequestException, ValueError):
+                    # Treated as not ready yet; the next tick asks again.
+                    dbs = None
+                now = time.time()
+                finished = []
+                with self.cond:
+                    for uid in uids:
+                        state = self.dbState(dbs.get(uid), busy) if dbs is not None else None
+                        remaining = []
+                        for waiter in self.waiters.get(uid, []):
+                            waiter['state'] = state
+                            if state is None and now >= waiter['deadline']:
+                                waiter['state'] = 'timeout'
+                            if waiter['state'] is None:
+                                remaining.append(waiter)
+                            else:
+                                finished.append(waiter)
+                        if len(remaining) > 0:
+                            self.waiters[uid] = remaining
+                        else:
+                            self.waiters.pop(uid, None)
+                for waiter in finished:
+                    self.finish(waiter)
+                with self.cond:
+                    if len(self.waiters) == 0:
+                        continue
+                    deadline = min(w['deadline'] for l in self.waiters.values() for w in l)
+                    self.cond.wait(max(0, min(delay, deadline - time.time())))
+                    if self.reset:
+                        delay = self.initial_delay
+                    else:
+                        delay = min(delay * 2, self.max_delay)
+        finally:
+            # Reached with the thread still registered only when the loop
+            # died; fail its waiters so no caller blocks forever.
+            left = []
+            with self.cond:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    left = [w for l in self.waiters.values() for w in l]
+                    self.waiters.clear()
+            for waiter in left:
+                waiter['state'] = 'polling failed'
+                self.finish(waiter)
+
 class DBAdmin():
-    list_options = ['db', 'shards']
-    create_options = ['ram', 'memory', 'port', 'replication', 'persist', 'eviction', 'dbpass']
-    change_options = ['ram', 'memory', 'shards', 'replication', 'persist', 'eviction', 'replicaof', 'dbpass']
+    list_options = ['db', 'shards', 'nodes', 'replicaof']
+    analyze_options = ['placement']
+    create_options = ['ram', 'memory', 'port', 'replication', 'persist', 'eviction', 'dbpass', '--wait']
+    change_options = ['ram', 'memory', 'shards', 'replication', 'persist', 'eviction', 'replicaof', 'dbpass', '--wait']
+    wait_timeout = 600
+    bulk_headers = ['Uid', 'Name', 'Result']
+    apply_workers = 8
+    top_options = ['sort', 'interval', 'count', 'window']
+    collect_options = ['file', 'interval', 'duration', 'downsample']
+    tail_options = ['db', 'lines', 'interval', 'count', '--format']
     replication_options = ['true', 'false']
     replicaof_options = ['add', 'off', 'start', 'stop']
     persist_options = ['aof-1sec', 'aof-always', 'snapshot-1hour', 'snapshot-6hours', 'snapshot-24hours', 'disabled']
@@ -294,21 +1935,142 @@ class DBAdmin():
     yes = ["TRUE", "YES", "1", "ON"]
     no = ["FALSE", "NO", "0", "OFF"]
     
-    def __init__(self, conn):
+    def __init__(self, conn, cache_ttl=0, index_ttl=300, load_cluster=True):
         self.conn = conn
         self.db_name_to_id = dict()
+        # The name index is patched from mutation responses and only fully
+        # refetched on a lookup miss or once it is older than index_ttl.
+        self.index_synced = 0
+        self.index_ttl = index_ttl
+        self.index_lock = threading.Lock()
+        self.index_thread = None
+        # Bumped on every change of db_name_to_id so derived indexes know
+        # when to rebuild.
+        self.index_version = 0
+        self.completion_index = None
+        # bdbs/<uid> documents keyed by uid string: (fetch time, document).
+        # Every command has its own cache on the thread that runs it; with a
+        # positive ttl entries are also shared across commands in db_cache.
+        self.db_cache = dict()
+        self.cache_lock = threading.Lock()
+        self.cache_ttl = cache_ttl
+        self.output_format = 'table'
+        self.lookahead = 0
         self.rackAware = False
-        resp = conn.get('cluster')
+        self.cluster_loaded = False
+        self.metadata = None
+        self.metadata_loaded = False
+        # Set when the index was patched; the cache file is then written
+        # once at the end of the command.
+        self.metadata_dirty = False
+        self.poller = CompletionPoller(conn)
+        self.local = threading.local()
+        # A request error of a background thread, kept until the next command
+        # reports it instead of printing a traceback over the prompt.
+        self.background_error = None
+        if load_cluster:
+            self.loadCluster()
+
+    def useMetadataCache(self, cache):
+        self.metadata = cache
+        entry = cache.load()
+        if entry is None:
+            return False
+        if entry['rack_aware'] is not None:
+            self.rackAware = entry['rack_aware']
+            self.cluster_loaded = True
+        self.db_name_to_id = dict((name, uid) for uid, name in entry['dbs'])
+        # Keeps its age, so index_ttl still bounds how long it is trusted.
+        self.index_synced = entry['t']
+        self.index_version += 1
+        self.metadata_loaded = True
+        self.conn.nodes.add(entry.get('nodes', []))
+        return True
+
+    def saveMetadata(self):
+        if self.metadata is not None and self.index_synced > 0:
+            self.metadata.save(self.rackAware if self.cluster_loaded else None, list(self.db_name_to_id.items()),
+                               list(self.conn.nodes.hosts), self.index_synced)
+
+    def discoverNodes(self):
+        try:
+            if self.conn.discoverNodes():
+                self.saveMetadata()
+        finally:
+            self.conn.startProbes()
+
+    def startBackground(self, target):
+        def run():
+            try:
+                target()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                with self.index_lock:
+                    if self.background_error is None:
+                        self.background_error = str(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def reportBackgroundError(self):
+        with self.index_lock:
+            error = self.background_error
+            self.background_error = None
+        if error is not None:
+            print('Error: ' + error)
+
+    def loadCluster(self):
+        resp = self.conn.get('cluster')
         if resp is not None:
             self.rackAware = resp['rack_aware']
-              
+            self.cluster_loaded = True
+            self.saveMetadata()
+        return resp is not None
+
+    def revalidate(self):
+        # On a request error the cached metadata stays in use.
+        if self.loadCluster():
+            self.dbNameToUid()
+
+    def bootstrap(self, need_index=True, trust_cache=False):
+        # With trust_cache (the interactive shell) and a metadata cache,
+        # everything is revalidated in the background. Otherwise the cluster,
+        # and so the credentials, is checked on this thread, and without a
+        # cached index it is fetched on a background thread meanwhile;
+        # lookups wait for it in waitForIndex. Cluster nodes are discovered
+        # and probed in the background either way; a request error there is
+        # reported by the next command.
+        self.startBackground(self.discoverNodes)
+        if self.metadata_loaded and trust_cache:
+            self.startBackground(self.revalidate)
+            return True
+        if need_index and not self.metadata_loaded:
+            self.index_thread = self.startBackground(self.dbNameToUid)
+        try:
+            return self.loadCluster()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print('Error: ' + str(e))
+            return False
+
+    def waitForIndex(self):
+        # Lookups fall back to fetching bdbs when the index thread failed;
+        # its error is printed once here.
+        thread = self.index_thread
+        if thread is not None:
+            thread.join()
+            self.index_thread = None
+            self.reportBackgroundError()
+
     def isRackAware(self):
+        if not self.cluster_loaded:
+            self.loadCluster()
         return self.rackAware
        
     def getDBs(self, ignore=''):
+        self.waitForIndex()
         names = []
         uids = []
-        items = self.db_name_to_id.items()
+        items = list(self.db_name_to_id.items())
         for i in items:
             if i[0] != ignore and str(i[1]) != ignore:
                 names.append(i[0])
@@ -316,36 +2078,141 @@ class DBAdmin():
         return names + uids
 
     def dbNameToUid(self):
-        self.db_name_to_id.clear()
-        resp = self.conn.get('bdbs')
+        resp = self.conn.stream('bdbs')
         if resp is not None:
+            index = dict()
             for db in resp:
-                self.db_name_to_id[db["name"]] = db['uid']
+                index[db["name"]] = db['uid']
+            with self.index_lock:
+                self.db_name_to_id = index
+                self.index_synced = time.time()
+                self.index_version += 1
+            self.saveMetadata()
             return True
         else:
             return False
+
+    def isIndexStale(self):
+        self.waitForIndex()
+        return time.time() - self.index_synced >= self.index_ttl
+
+    def syncNameIndex(self):
+        if self.isIndexStale():
+            return self.dbNameToUid()
+        return True
+
+    def indexDB(self, db):
+        uid = db['uid']
+        with self.index_lock:
+            for name in [n for n, u in self.db_name_to_id.items() if u == uid]:
+                del self.db_name_to_id[name]
+            self.db_name_to_id[db['name']] = uid
+            self.index_version += 1
+            self.metadata_dirty = True
+
+    def unindexDB(self, uid):
+        with self.index_lock:
+            for name in [n for n, u in self.db_name_to_id.items() if u == uid]:
+                del self.db_name_to_id[name]
+            self.index_version += 1
+            self.metadata_dirty = True
+
+    def getCompletionIndex(self):
+        self.waitForIndex()
+        index = self.completion_index
+        if index is None or index[0] != self.index_version:
+            with self.index_lock:
+                index = (self.index_version, CompletionIndex(self.db_name_to_id))
+            self.completion_index = index
+        return index[1]
+
+    def getDBName(self, uid):
+        for name, u in list(self.db_name_to_id.items()):
+            if u == uid:
+                return name
+        return None
  
     def getDBUid(self, param):
         uid = -1
         try:
             uid = int(param)
         except ValueError:
-            try:
-                uid = self.db_name_to_id[param]      
-            except KeyError:
-                return -1
+            refreshed = self.isIndexStale() and self.dbNameToUid()
+            uid = self.db_name_to_id.get(param, -1)
+            if uid < 0 and not refreshed:
+                # The name may have been created elsewhere since the last sync.
+                if self.dbNameToUid():
+                    uid = self.db_name_to_id.get(param, -1)
         
         return uid
     
+    def beginCommand(self):
+        # Starts the deadline and the bdbs/<uid> cache of a command on the
+        # calling thread, so concurrent commands do not clear each other's.
+        self.conn.startCommand()
+        self.reportBackgroundError()
+        self.local.db_cache = dict()
+        if self.cache_ttl > 0:
+            now = time.time()
+            with self.cache_lock:
+                for uid, entry in list(self.db_cache.items()):
+                    if now - entry[0] >= self.cache_ttl:
+                        del self.db_cache[uid]
+
+    def endCommand(self):
+        with self.index_lock:
+            dirty = self.metadata_dirty
+            self.metadata_dirty = False
+        if dirty:
+            self.saveMetadata()
+
+    def commandCache(self):
+        cache = getattr(self.local, 'db_cache', None)
+        if cache is None:
+            cache = dict()
+            self.local.db_cache = cache
+        return cache
+
+    def setCommandCache(self, cache):
+        # Worker threads of a command share the cache of the command.
+        self.local.db_cache = cache
+
+    def cacheDB(self, db, now):
+        uid = str(db['uid'])
+        self.commandCache()[uid] = (now, db)
+        if self.cache_ttl > 0:
+            with self.cache_lock:
+                self.db_cache[uid] = (now, db)
+
+    def invalidateDB(self, uid):
+        self.commandCache().pop(str(uid), None)
+        with self.cache_lock:
+            self.db_cache.pop(str(uid), None)
+
+    def getDB(self, uid):
+        uid = str(uid)
+        entry = self.commandCache().get(uid)
+        if entry is None and self.cache_ttl > 0:
+            with self.cache_lock:
+                entry = self.db_cache.get(uid)
+            if entry is not None and time.time() - entry[0] >= self.cache_ttl:
+                entry = None
+        if entry is not None:
+            return entry[1]
+        resp = self.conn.get('bdbs/' + uid)
+        if resp is not None:
+            self.cacheDB(resp, time.time())
+        return resp
+
     def getReplication(self, db):
-        resp = self.conn.get('bdbs/' + db)
+        resp = self.getDB(db)
         if resp is not None:
             return resp['replication']
         else:
             return False
         
     def getMemorySize(self, db):
-        resp = self.conn.get('bdbs/' + db)
+        resp = self.getDB(db)
         if resp is not None:
             return resp['memory_size']
         else:
@@ -353,7 +2220,7 @@ class DBAdmin():
     
     def getReplicaOfUri(self, db):
         uri = ''
-        resp = self.conn.get('bdbs/' + str(db))
+        resp = self.getDB(db)
         if resp is not None:
             uri = 'redis://admin:' + resp['authentication_admin_pass'] + '@' + resp['endpoints'][0]['dns_name'] + ':' + str(resp['endpoints'][0]['port'])
         else:
@@ -361,29 +2228,79 @@ class DBAdmin():
         return uri
 
     def getReplicaOfList(self, db):
-        resp = self.conn.get('bdbs/' + db)
+        resp = self.getDB(db)
         if resp is not None:
-            return resp['sync_sources']
+            return list(resp['sync_sources'])
         else:
             return None
                 
     def getRepOf(self, dest, src):
+        # Destination and source both come from one bdbs request, and the
+        # existing sources are compared by the database they resolve to.
+        graph = self.loadReplicaOf()
+        if graph is None:
+            return ''
         repof = self.getReplicaOfList(dest)
         uri = ''
-        uid = self.getDBUid(src)
-        if uid < 0:
+        uid = graph.resolve(src)
+        if uid >= 0 or '://' in src:
             uri = src
         else:
-            uri = self.getReplicaOfUri(uid)
+            uid = self.getDBUid(src)
+            if uid < 0:
+                uri = src
+            else:
+                uri = self.getReplicaOfUri(uid)
         
         for r in repof:
-            if r['uri'] == uri:
+            if r['uri'] == uri or uid >= 0 and graph.resolve(r['uri']) == uid:
                 print('Database is already a replica of this Uri')
                 return ''
             
         repof.append({"uri": uri})
         return json.dumps(repof)
      
+    def getWaitParam(self, params):
+        # Strips "--wait [timeout]" from the command parameters.
+        if '--wait' not in params:
+            return params, None
+        idx = params.index('--wait')
+        timeout = DBAdmin.wait_timeout
+        rest = params[idx + 1:]
+        if len(rest) > 0:
+            try:
+                timeout = float(rest[0])
+                rest = rest[1:]
+            except ValueError:
+                pass
+        return params[:idx] + rest, timeout
+
+    def deferWaits(self, defer):
+        # With defer set, waitForDB on this thread only records the database
+        # and batch mode waits for it through the poller without holding a
+        # worker. Returns the wait recorded since the last call.
+        deferred = getattr(self.local, 'deferred', None)
+        self.local.defer_waits = defer
+        self.local.deferred = None
+        return deferred
+
+    def waitForDB(self, uid, timeout):
+        print('Waiting for database ' + str(uid) + ' to become active...')
+        if getattr(self.local, 'defer_waits', False):
+            self.local.deferred = (uid, timeout)
+            return True
+        return self.waitResult(uid, self.poller.wait(uid, timeout))
+
+    def waitResult(self, uid, state):
+        if state == 'active':
+            print('Database ' + str(uid) + ' is active')
+            return True
+        elif state == 'timeout':
+            print('Timed out waiting for database ' + str(uid))
+        else:
+            print('Database ' + str(uid) + ' failed: ' + state)
+        return False
+
     def getPersistParams(self, param):
         if param not in DBAdmin.persist_options:
                 print('Illegal parameter for persistence: ' + param)
@@ -408,70 +2325,196 @@ class DBAdmin():
             data += ',"snapshot_policy": [{ "secs": ' + str(int(period) * 3600) + ',"writes": 1 }]'
         return data
         
-    def listdb(self, uid):
+    def setOutput(self, fmt, lookahead):
+        # Output defaults of the commands run on the calling thread, for a
+        # daemon client that passed --format or --lookahead; None keeps the
+        # process wide setting.
+        self.local.output_format = fmt
+        self.local.lookahead = lookahead
+
+    def outputFormat(self):
+        fmt = getattr(self.local, 'output_format', None)
+        return fmt if fmt is not None else self.output_format
+
+    def outputLookahead(self):
+        lookahead = getattr(self.local, 'lookahead', None)
+        return lookahead if lookahead is not None else self.lookahead
+
+    def setWorkDir(self, cwd):
+        # Directory that relative file arguments of the commands run on the
+        # calling thread are resolved against, for a daemon client started
+        # in another directory; None keeps the process working directory.
+        self.local.cwd = cwd
+
+    def localPath(self, path):
+        cwd = getattr(self.local, 'cwd', None)
+        return os.path.join(cwd, path) if cwd is not None else path
+
+    def printRows(self, rows, headers, fmt=None):
+        printRows(rows, headers, fmt if fmt is not None else self.outputFormat(), self.outputLookahead())
+
+    def getFormatParam(self, params):
+        return formatParam(params, self.outputFormat())
+
+    def listdb(self, uid, query=None, fmt=None):
+        # fmt is passed down rather than set on the instance, since commands
+        # of a batch, background jobs and daemon clients share this DBAdmin.
+        if fmt is None:
+            fmt = self.outputFormat()
         url = 'bdbs'
-        rows = []
         if uid != '':
-            url += '/' + uid
-            resp = self.conn.get(url)
+            resp = self.getDB(uid)
             if resp is not None:
-                rows.append(dbToRow(resp))
-                printTable(rows, db_headers)
+                self.printRows([dbToRow(resp)], db_headers, fmt)
                 repof = resp['sync_sources']
-                if len(repof) > 0:
+                if len(repof) > 0 and fmt == 'table':
                     print('\nReplica of:')
                     print('Status: ' + resp['sync'])
                     for r in repof:
                         print('URI: ' + r['uri'])
                         print('Status: ' + r['status'])
         else:
-            resp = self.conn.get(url)
+            resp = self.conn.stream(url)
             if resp is not None:
-                for db in resp:
-                    rows.append(dbToRow(db))
-                printTable(rows, db_headers)
+                if not query:
+                    self.printRows((dbToRow(db) for db in resp), db_headers, fmt)
+                    return True
+                return self.printQuery(RecordStore(db_columns, db_sums).extend(resp), query, db_headers,
+                                       dbRecordToRow, fmt)
+        return resp is not None
 
-    def listshard(self, uid):
-        rows = []
+    def printQuery(self, store, params, headers, toRow, fmt=None):
+        try:
+            query = store.parseQuery(params or [])
+        except (ValueError, re.error) as e:
+            print(str(e))
+            return False
+        if query['group'] is not None:
+            rows, headers = store.group(query)
+            self.printRows(rows, headers, fmt)
+        else:
+            self.printRows((toRow(store.record(r)) for r in store.select(query)), headers, fmt)
+        return True
+
+    def listshard(self, uid, query=None, fmt=None):
         url = ''
         if uid != '':
             url = 'bdbs/' + uid + '/shards'
         else:
             url = 'shards'
             
-        resp = self.conn.get(url)
-        if resp is not None:
-            for shard in resp:
-                rows.append(shardToRow(shard))
-        
-            printTable(rows, shard_headers)
+        resp = self.conn.stream(url)
+        if resp is None:
+            return False
+        if not query:
+            self.printRows((shardToRow(shard) for shard in resp), shard_headers, fmt)
+            return True
+        return self.printQuery(RecordStore(shard_columns).extend(resp), query, shard_headers, shardToRow, fmt)
+
+    def loadReplicaOf(self):
+        # One bdbs request; the documents also fill the per-command cache.
+        resp = self.conn.get('bdbs')
+        if resp is None:
+            return None
+        now = time.time()
+        for db in resp:
+            self.cacheDB(db, now)
+        return ReplicaOfGraph(resp)
+
+    def listreplicaof(self, uid=None, fmt=None):
+        if fmt is None:
+            fmt = self.outputFormat()
+        graph = self.loadReplicaOf()
+        if graph is None:
+            return False
+        links = list(graph.links(uid))
+        self.printRows((graph.toRow(*link) for link in links), ReplicaOfGraph.link_headers, fmt)
+        if fmt == 'table':
+            missing = len([l for l in links if l[2] < 0])
+            cycles = len([u for u in graph.in_cycle if uid is None or u == uid])
+            print(str(len(links)) + ' links, ' + str(missing) + ' missing sources, '
+                  + str(cycles) + ' databases in cycles')
+        return True
+
+    def listnodes(self, fmt=None):
+        analysis = PlacementAnalysis(self.conn)
+        if not analysis.fetch():
+            return False
+        analysis.analyze()
+        self.printRows(analysis.nodeRows(), PlacementAnalysis.node_headers, fmt)
+        return True
+
+    def exec_analyze(self, params):
+        params, fmt = self.getFormatParam(params)
+        if params is None:
+            return False
+        if len(params) < 1 or params[0] not in DBAdmin.analyze_options:
+            print('Missing or invalid analysis, must be one of: ' + ' '.join(DBAdmin.analyze_options))
+            return False
+        analysis = PlacementAnalysis(self.conn)
+        if not analysis.fetch():
+            return False
+        analysis.analyze()
+        if fmt != 'table':
+            printRows(analysis.colocated, PlacementAnalysis.colocated_headers, fmt, self.outputLookahead())
+            return True
+        print('Nodes:')
+        printTable(list(analysis.nodeRows()), PlacementAnalysis.node_headers)
+        masters, shards, memory = analysis.scores()
+        print('Imbalance (busiest node above average): masters %.0f%%, shards %.0f%%, memory %.0f%%'
+              % (masters * 100, shards * 100, memory * 100))
+        if len(analysis.colocated) == 0:
+            print('No master and replica share a node or rack')
+        else:
+            print('\nMaster and replica on the same node or rack:')
+            printTable(analysis.colocated, PlacementAnalysis.colocated_headers)
+        return True
                    
     def exec_list(self, params):
+        params, fmt = self.getFormatParam(params)
+        if params is None:
+            return False
+        return self.listEntity(params, fmt)
+
+    def listEntity(self, params, fmt):
         if len(params) == 0:
             print("Databases:")
-            self.listdb('')
+            self.listdb('', fmt=fmt)
             print("\nShards:")
-            self.listshard('')
-            return
+            return self.listshard('', fmt=fmt)
         
         entity = params[0]
         uid = ''
-        if len(params) > 1:
+        query = params[1:]
+        if len(params) > 1 and params[1] not in RecordStore.query_words:
             uid = self.getDBUid(params[1])
             if uid < 0:
                 print("Database does not exist: " + params[1])
-                return
+                return False
+            query = params[2:]
+        if len(query) > 0 and entity not in ['db', 'shards']:
+            print('Queries are supported by list db and list shards only')
+            return False
+        if len(query) > 0 and entity == 'db' and uid != '':
+            print('Queries are not supported when listing a single database')
+            return False
         if entity == 'db':
-            self.listdb(str(uid))
+            return self.listdb(str(uid), query, fmt)
+        elif entity == 'nodes':
+            return self.listnodes(fmt)
+        elif entity == 'replicaof':
+            return self.listreplicaof(uid if uid != '' else None, fmt)
         elif entity == 'shards':
-            self.listshard(str(uid))
+            return self.listshard(str(uid), query, fmt)
         else:
             print('Invalid entity: ' + entity)          
+            return False
 
     def exec_create(self, params):
+        params, wait = self.getWaitParam(params)
         if len(params) < 1:
             print('Missing database name')
-            return 
+            return False
         name = params[0]
         memory_size = 1 * GIGABYTE
         ram_size = 0
@@ -492,31 +2535,31 @@ class DBAdmin():
             if p == 'memory':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 try:
                     memory_size = int(params[1]) * GIGABYTE
                 except ValueError:
                     print('Illegal memory size: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             elif p == 'ram':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 try:
                     ram_size = int(params[1]) * GIGABYTE
                     flash = True
                 except ValueError:
                     print('Illegal ram size: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             elif p == 'port':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 try:
                     port = int(params[1])
                 except ValueError:
                     print('Illegal port number: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             if p == 'replication':
                 replication = True
             elif p == 'rack':
@@ -524,39 +2567,39 @@ class DBAdmin():
             elif p == 'persist':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 persist, persist_param = self.getPersistParams(params[1].lower())
             elif p == 'eviction':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 eviction = params[1].lower();
                 if eviction not in DBAdmin.eviction_options:
                     print('Illegal eviction policy: ' + params[1])
-                    return
+                    return False
             elif p == 'dbpass':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 password = params[1]
             elif p == 'json':
                 data = params[1]
             
             params = params[2:]
         
-        self.dbNameToUid()
+        self.syncNameIndex()
         if data == '':
             if ram_size > memory_size:
                 print('Illegal RAM size: ' + str(ram_size) + '. Must less than total memory size: ' + str(memory_size))
-                return
+                return False
                 
             if name in self.db_name_to_id:
                 print('A database with this name already exist: ' + name)
-                return
+                return False
             
             if rack == True and replication == False:
                 print('Replication must be enabled for rack zone awareness.')
-                return
+                return False
             
             data = '{ "name": "' + name + '", "type": "redis",  "memory_size": ' + str(memory_size) + ', "port": ' + str(port) 
             if flash == True:
@@ -575,34 +2618,146 @@ class DBAdmin():
         resp = self.conn.post('bdbs', data)
         if resp is not None:
             uid = resp['uid']
+            self.invalidateDB(uid)
+            self.indexDB(resp)
             self.listdb(str(uid))
-            self.dbNameToUid()
+            if wait is not None:
+                return self.waitForDB(uid, wait)
+            return True
+        return False
         
 
+    def getBulkParams(self, params):
+        # Strips "--dry-run", "--yes" and "--parallel <n>" from the command
+        # parameters.
+        dry_run = '--dry-run' in params
+        yes = '--yes' in params
+        params = [p for p in params if p not in ['--dry-run', '--yes']]
+        parallel = DBAdmin.apply_workers
+        if '--parallel' in params:
+            idx = params.index('--parallel')
+            try:
+                parallel = int(params[idx + 1])
+                if parallel < 1:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                print('Illegal parallel limit, must be a positive number')
+                return None, False, False, 0
+            params = params[:idx] + params[idx + 2:]
+        return params, dry_run, yes, parallel
+
+    def confirm(self, question):
+        # Only the foreground of the interactive shell can ask; batch lines,
+        # background jobs and daemon clients must pass --yes instead.
+        if not getattr(self.local, 'interactive', False):
+            return False
+        answer = input(question + ' [y/N] ')
+        return answer.strip().lower() in ['y', 'yes']
+
+    def bulkOne(self, fn, db, params, deadline, cache):
+        self.conn.setDeadline(deadline)
+        self.setCommandCache(cache)
+        router = sys.stdout
+        router.capture()
+        try:
+            ok = fn([str(db['uid'])] + params) == True
+        except Exception as e:
+            print('Error: ' + str(e))
+            ok = False
+        return ok, router.release()
+
+    def exec_bulk(self, fn, params):
+        # "all ..." or "where <selector> ..." runs fn for every matching
+        # database. Matches come from one bdbs request whose documents also
+        # fill the per-command cache, so fn does not fetch them again.
+        params, dry_run, yes, parallel = self.getBulkParams(params)
+        if params is None:
+            return False
+        select = lambda db: True
+        if params[0] == 'where':
+            if len(params) < 2:
+                print('Missing selector for where')
+                return False
+            select = dbSelector(params[1])
+            if select is None:
+                print('Illegal selector: ' + params[1] + '. Must be <field>=<value>, <field>!=<value> or <field>~<regex>')
+                return False
+            params = params[2:]
+        else:
+            params = params[1:]
+        resp = self.conn.get('bdbs')
+        if resp is None:
+            return False
+        matched = [db for db in sorted(resp, key=lambda db: db['uid']) if select(db)]
+        if len(matched) == 0:
+            print('No database matches')
+            return True
+        if dry_run:
+            printTable([[str(db['uid']), db['name'], 'would run'] for db in matched], DBAdmin.bulk_headers)
+            print(str(len(matched)) + ' databases match')
+            return True
+        if fn == self.exec_delete and not yes:
+            printTable([[str(db['uid']), db['name'], 'would delete'] for db in matched], DBAdmin.bulk_headers)
+            if not self.confirm('Delete ' + str(len(matched)) + ' databases?'):
+                print('Nothing deleted, pass --yes to delete ' + str(len(matched)) + ' databases')
+                return False
+        now = time.time()
+        for db in matched:
+            self.cacheDB(db, now)
+        deadline = self.conn.getDeadline()
+        cache = self.commandCache()
+        stdout = sys.stdout
+        if not isinstance(stdout, OutputRouter):
+            sys.stdout = OutputRouter(stdout)
+        rows = []
+        failed = 0
+        try:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = [executor.submit(self.bulkOne, fn, db, params, deadline, cache) for db in matched]
+                for db, future in zip(matched, futures):
+                    ok, output = future.result()
+                    print(db['name'] + ': ' + output, end='')
+                    rows.append([str(db['uid']), db['name'], 'OK' if ok else 'Failed'])
+                    if not ok:
+                        failed += 1
+        finally:
+            sys.stdout = stdout
+        printTable(rows, DBAdmin.bulk_headers)
+        print(str(len(matched) - failed) + ' succeeded, ' + str(failed) + ' failed')
+        return failed == 0
+
     def exec_delete(self, params):
         if len(params) < 1:
             print('Missing parameters for delete')
-            return
+            return False
+        if params[0] in ['all', 'where']:
+            return self.exec_bulk(self.exec_delete, params)
         
-        self.dbNameToUid()
         uid = self.getDBUid(params[0])
         if uid < 0:
             print("Database does not exist: " + params[0])
-            return
+            return False
         
-        self.conn.delete('bdbs/' + str(uid))
-        self.dbNameToUid()
+        deleted = self.conn.delete('bdbs/' + str(uid))
+        if deleted:
+            self.unindexDB(uid)
+        self.invalidateDB(uid)
+        return deleted
 
     def exec_change(self, params):
+        params, wait = self.getWaitParam(params)
         if len(params) < 1:
             print('Missing parameters for change')
-            return
+            return False
+        if params[0] in ['all', 'where']:
+            if wait is not None:
+                params = params + ['--wait', str(wait)]
+            return self.exec_bulk(self.exec_change, params)
         
-        self.dbNameToUid()
         uid = self.getDBUid(params[0])
         if uid < 0:
             print("Database does not exist: " + params[0])
-            return
+            return False
         
         params = params[1:]
         replication_changed = False
@@ -629,7 +2784,7 @@ class DBAdmin():
                 replication_changed = True
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 rep_param = params[1]
                 if rep_param.upper() in DBAdmin.yes:
                     replication = 'true'
@@ -637,27 +2792,27 @@ class DBAdmin():
                     replication = 'false'
                 else:
                     print('Illegal parameter for replication: ' + rep_param)
-                    return
+                    return False
             elif p == 'persist':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 persist, persist_param = self.getPersistParams(params[1].lower())
             elif p == 'eviction':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 eviction = params[1].lower();
                 if eviction not in DBAdmin.eviction_options:
                     print('Illegal eviction policy: ' + params[1])
-                    return
+                    return False
             elif p == 'rack':
-                if self.rackAware == False:
+                if self.isRackAware() == False:
                     print("Cluster does not support rack zone awareness.")
-                    return
+                    return False
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 rack_param = params[1]
                 if rack_param.upper() in DBAdmin.yes:
                     rack = 'true'
@@ -665,21 +2820,21 @@ class DBAdmin():
                     rack = 'false'
                 else:
                     print('Illegal parameter for rack: ' + rack_param)
-                    return
+                    return False
             elif p == 'shards':
                 sharding = True
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 try:
                     shards = int(params[1])
                 except ValueError:
                     print('Illegal parameter for number of shards: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             elif p == 'replicaof':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 
                 action = params[1]
                 if action == 'add':
@@ -695,41 +2850,41 @@ class DBAdmin():
                     sync = 'paused'
                 else: 
                     print ('Illegal replicaof action: ' + action)
-                    return
+                    return False
                 
                 replicaOf = True
             elif p == 'ram':
                 if len(params) < 2:
                     print('Missing RAM size for flash')
-                    return
+                    return False
             
                 try:
                     ram_size = int(params[1]) * GIGABYTE
                     flash = True
                 except ValueError:
                     print('Illegal RAM size: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             elif p == 'memory':
                 if len(params) < 2:
                     print('Missing memory size')
-                    return
+                    return False
                 try:
                     memory_size = int(params[1]) * GIGABYTE
                     memory = True
                 except ValueError:
                     print('Illegal memory size: ' + params[1] + '. Must be a number')
-                    return
+                    return False
             elif p == 'dbpass':
                 if len(params) < 2:
                     print("Missing parameter for :" + p)
-                    return
+                    return False
                 password = params[1]
                 password_changed = True
             elif p == 'json':
                 data = params[1]         
             else:
                 print('Invalid change action: ' + p)
-                return
+                return False
             params = params[2:]
         
         if data == '':
@@ -737,11 +2892,11 @@ class DBAdmin():
                 memory_size = self.getMemorySize(str(uid))
             if ram_size > memory_size:
                 print('Illegal RAM size: ' + params[1] + '. Must less than total memory size: ' + str(memory_size / GIGABYTE))
-                return
+                return False
             
             if rack == 'true' and (replication == 'false' or replication_changed == False and self.getReplication(str(uid)) == False):
                 print('Replication must be enabled for rack zone awareness.')
-                return
+                return False
             data = '{ '
             if replication_changed == True:
                 data += '"replication": ' + replication
@@ -771,17 +2926,479 @@ class DBAdmin():
             if data[2] == ',':
                 data = data[:2] + data[3:]
                 
-        self.conn.put('bdbs/' + str(uid), data)
+        resp = self.conn.put('bdbs/' + str(uid), data)
+        self.invalidateDB(uid)
+        if resp is None:
+            return False
+        if 'name' in resp:
+            self.indexDB(resp)
+        if wait is not None:
+            return self.waitForDB(uid, wait)
+        return True
+
+    def loadSpec(self, path):
+        # A spec file is a json list of database specs as written by export.
+        with open(self.localPath(path)) as f:
+            specs = json.load(f)
+        names = set()
+        for spec in specs:
+            if 'name' not in spec:
+                raise ValueError('Missing name in database spec: ' + json.dumps(spec))
+            if spec['name'] in names:
+                raise ValueError('Duplicate database in spec: ' + spec['name'])
+            names.add(spec['name'])
+        return specs
+
+    def exec_export(self, params):
+        if len(params) < 1:
+            print('Missing spec file')
+            return False
+        resp = self.conn.get('bdbs')
+        if resp is None:
+            return False
+        specs = [dbToSpec(db) for db in sorted(resp, key=lambda db: db['uid'])]
+        try:
+            # Owner only: sync source uris include the sources' passwords.
+            fd = os.open(self.localPath(params[0]), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(specs, f, indent=2)
+                f.write('\n')
+        except IOError as e:
+            print('Cannot write spec file: ' + str(e))
+            return False
+        print('Exported ' + str(len(specs)) + ' databases to ' + params[0])
+        return True
+
+    def planSpec(self, path):
+        # Diffs every spec against the live databases, fetched with a single
+        # bdbs request. Returns a list of (spec, db, changes); db is None for
+        # a database that does not exist yet.
+        try:
+            specs = self.loadSpec(path)
+        except (IOError, ValueError) as e:
+            print('Cannot read spec file: ' + str(e))
+            return None
+        resp = self.conn.get('bdbs')
+        if resp is None:
+            return None
+        live = dict((db['name'], db) for db in resp)
+        plan = []
+        for spec in specs:
+            db = live.get(spec['name'])
+            if db is None:
+                plan.append((spec, None, dict((f, spec[f]) for f in spec_fields if f in spec)))
+            else:
+                changes = specDiff(spec, db)
+                if len(changes) > 0:
+                    plan.append((spec, db, changes))
+        return plan, len(specs)
+
+    def planToRows(self, plan):
+        for spec, db, changes in plan:
+            uid = str(db['uid']) if db is not None else '(new)'
+            for field, value in changes.items():
+                current = ''
+                if db is not None:
+                    current = db.get(field)
+                    if field == 'sync_sources' and current is not None:
+                        current = maskSources(current)
+                    current = json.dumps(current)
+                if field == 'sync_sources':
+                    value = maskSources(value)
+                yield [uid, spec['name'], field, current, json.dumps(value)]
+
+    def exec_plan(self, params):
+        params, fmt = self.getFormatParam(params)
+        if params is None:
+            return False
+        if len(params) < 1:
+            print('Missing spec file')
+            return False
+        result = self.planSpec(params[0])
+        if result is None:
+            return False
+        plan, total = result
+        if len(plan) == 0:
+            print('No changes, ' + str(total) + ' databases match the spec')
+            return True
+        printRows(self.planToRows(plan), plan_headers, fmt, self.outputLookahead())
+        if fmt == 'table':
+            creates = len([p for p in plan if p[1] is None])
+            print(str(len(plan) - creates) + ' to change, ' + str(creates) + ' to create, '
+                  + str(total - len(plan)) + ' unchanged')
+        return True
+
+    def applyOne(self, spec, db, changes, deadline, cache):
+        self.conn.setDeadline(deadline)
+        self.setCommandCache(cache)
+        router = sys.stdout
+        router.capture()
+        try:
+            print(spec['name'] + ':', end=' ')
+            if db is None:
+                data = dict(changes)
+                data['name'] = spec['name']
+                data['type'] = 'redis'
+                resp = self.conn.post('bdbs', json.dumps(data))
+                if resp is not None:
+                    self.invalidateDB(resp['uid'])
+                    self.indexDB(resp)
+                return resp is not None, router.release()
+            data = dict(changes)
+            if 'shards_count' in data:
+                data['shard_key_regex'] = [{'regex': '.*\\{(?<tag>.*)\\}.*'}, {'regex': '(?<tag>.*)'}]
+            if 'sync_sources' in data:
+                if len(data['sync_sources']) == 0:
+                    data['sync'] = 'disabled'
+                elif db.get('sync') == 'disabled':
+                    data['sync'] = 'enabled'
+            resp = self.conn.put('bdbs/' + str(db['uid']), json.dumps(data))
+            self.invalidateDB(db['uid'])
+            return resp is not None, router.release()
+        except Exception as e:
+            print('Error: ' + str(e))
+            return False, router.release()
+
+    def exec_apply(self, params):
+        if len(params) < 1:
+            print('Missing spec file')
+            return False
+        result = self.planSpec(params[0])
+        if result is None:
+            return False
+        plan, total = result
+        if len(plan) == 0:
+            print('No changes, ' + str(total) + ' databases match the spec')
+            return True
+        # Databases are independent, so their updates run in parallel; the
+        # output of each is printed in spec order.
+        deadline = self.conn.getDeadline()
+        cache = self.commandCache()
+        stdout = sys.stdout
+        if not isinstance(stdout, OutputRouter):
+            sys.stdout = OutputRouter(stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=DBAdmin.apply_workers) as executor:
+                futures = [executor.submit(self.applyOne, spec, db, changes, deadline, cache)
+                           for spec, db, changes in plan]
+                failed = 0
+                for future in futures:
+                    ok, output = future.result()
+                    print(output, end='')
+                    if not ok:
+                        failed += 1
+        finally:
+            sys.stdout = stdout
+        print('Applied ' + str(len(plan) - failed) + ' of ' + str(len(plan)) + ' changed databases, '
+              + str(total - len(plan)) + ' unchanged')
+        return failed == 0
+
+    def exec_top(self, params):
+        interval = 2
+        sort = 'ops'
+        count = 0
+        window = 30
+        while len(params) > 0:
+            p = params[0]
+            if len(params) < 2:
+                print("Missing parameter for :" + p)
+                return False
+            if p == 'sort':
+                sort = params[1]
+                if sort not in DBTop.sort_columns:
+                    print('Illegal sort column, must be one of: ' + ' '.join(DBTop.sort_columns))
+                    return False
+            elif p in ['interval', 'count', 'window']:
+                try:
+                    value = float(params[1]) if p == 'interval' else int(params[1])
+                except ValueError:
+                    print('Illegal ' + p + ': ' + params[1] + '. Must be a number')
+                    return False
+                if value <= 0:
+                    raise ValueError('Illegal ' + p + ': ' + params[1] + '. Must be greater than 0, usage: ' + DBTop.usage)
+                if p == 'interval':
+                    interval = value
+                elif p == 'count':
+                    count = value
+                else:
+                    window = value
+            else:
+                print('Invalid top option: ' + p)
+                return False
+            params = params[2:]
+        return DBTop(self, interval, window, sort, count).run()
+
+    def exec_tail(self, params):
+        params, fmt = self.getFormatParam(params)
+        if params is None:
+            return False
+        if fmt not in ['table', 'jsonl']:
+            print('tail supports the table and jsonl formats only')
+            return False
+        uid = None
+        interval = 2
+        lines = 20
+        count = 0
+        while len(params) > 0:
+            p = params[0]
+            if len(params) < 2:
+                print("Missing parameter for :" + p)
+                return False
+            if p == 'db':
+                uid = self.getDBUid(params[1])
+                if uid < 0:
+                    print("Database does not exist: " + params[1])
+                    return False
+            elif p in ['interval', 'lines', 'count']:
+                try:
+                    value = float(params[1]) if p == 'interval' else int(params[1])
+                except ValueError:
+                    print('Illegal ' + p + ': ' + params[1] + '. Must be a number')
+                    return False
+                if p == 'interval':
+                    interval = value
+                elif p == 'lines':
+                    lines = value
+                else:
+                    count = value
+            else:
+                print('Invalid tail option: ' + p)
+                return False
+            params = params[2:]
+        return LogTail(self.conn, uid, interval, lines, count, fmt).run()
+
+    def exec_collect(self, params):
+        path = 'dbadmin-stats.csv'
+        interval = 10
+        duration = 0
+        downsample = 1
+        while len(params) > 0:
+            p = params[0]
+            if len(params) < 2:
+                print("Missing parameter for :" + p)
+                return False
+            if p == 'file':
+                path = params[1]
+            elif p in ['interval', 'duration', 'downsample']:
+                try:
+                    value = float(params[1]) if p != 'downsample' else int(params[1])
+                except ValueError:
+                    print('Illegal ' + p + ': ' + params[1] + '. Must be a number')
+                    return False
+                if p == 'interval':
+                    interval = value
+                elif p == 'duration':
+                    duration = value
+                else:
+                    downsample = value
+            else:
+                print('Invalid collect option: ' + p)
+                return False
+            params = params[2:]
+        try:
+            return StatsCollector(self.conn, self.localPath(path), interval, downsample).run(duration)
+        except IOError as e:
+            print('Cannot write stats file: ' + str(e))
+            return False
+
+    def exec_report(self, params):
+        params, fmt = self.getFormatParam(params)
+        if params is None:
+            return False
+        if len(params) < 1:
+            print('Missing stats file')
+            return False
+        bdb_uid = None
+        if len(params) > 2 and params[1] == 'db':
+            bdb_uid = self.getDBUid(params[2])
+            if bdb_uid < 0:
+                print("Database does not exist: " + params[2])
+                return False
+        try:
+            rows = statsReport(self.localPath(params[0]), bdb_uid)
+        except (IOError, ValueError, IndexError) as e:
+            print('Cannot read stats file: ' + str(e))
+            return False
+        printRows(rows, stats_report_headers, fmt, self.outputLookahead())
+        return True
+
+    def exec_stats(self, params):
+        opened, reused = self.conn.connectionStats()
+        print('Connections opened: ' + str(opened))
+        print('Connections reused: ' + str(reused))
+        print('In flight limit: %.1f of %d' % (self.conn.limiter.limit, self.conn.limiter.max_limit))
+        print('Retried requests: ' + str(self.conn.retried))
+        nodes = self.conn.nodes
+        for host in list(nodes.hosts):
+            latency = nodes.latency.get(host)
+            print('Node ' + host + ': ' + ('%.1fms' % (latency * 1000) if latency is not None else 'not probed')
+                  + (' (down)' if host in nodes.down else '') + (' (current)' if host == nodes.current else ''))
+        print("")
+        self.conn.recorder.printReport()
+        return True
+
+class ShellJob(object):
+
+    def __init__(self, id, text, params):
+        self.id = id
+        self.text = text
+        self.params = params
+        self.state = 'queued'
+        self.ok = False
+        self.output = ''
+        self.started = 0
+        self.finished = 0
+        self.reported = False
+        self.future = None
+        self.done = threading.Event()
+
+class JobManager:
+    # Runs shell commands ending with '&' on worker threads that share the
+    # admin and its connection pool. Output is captured per job and shown
+    # at the next prompt.
+    job_headers = ['Id', 'State', 'Time', 'Command']
+
+    def __init__(self, shell, workers=4):
+        self.shell = shell
+        self.workers = workers
+        self.executor = None
+        self.jobs = collections.OrderedDict()
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def submit(self, text, params):
+        if not isinstance(sys.stdout, OutputRouter):
+            sys.stdout = OutputRouter(sys.stdout)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        with self.lock:
+            job = ShellJob(self.next_id, text, params)
+            self.next_id += 1
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self.run, job)
+        print('[' + str(job.id) + '] ' + text)
+        return job
+
+    def run(self, job):
+        with self.lock:
+            if job.state == 'cancelled':
+                job.done.set()
+                return
+            job.state = 'running'
+            job.started = time.time()
+        router = sys.stdout
+        router.capture()
+        try:
+            job.ok = self.shell.execCommand(job.params) == True
+        except Exception as e:
+            print('Error: ' + str(e))
+            job.ok = False
+        output = router.release()
+        with self.lock:
+            job.finished = time.time()
+            if job.state != 'cancelled':
+                job.state = 'done' if job.ok else 'failed'
+                job.output = output
+        job.done.set()
+
+    def elapsed(self, job):
+        if job.started == 0:
+            return ''
+        end = job.finished if job.finished > 0 else time.time()
+        return '%.1fs' % (end - job.started)
+
+    def report(self, job):
+        job.reported = True
+        print('[' + str(job.id) + '] ' + job.state.capitalize() + '  ' + job.text)
+        print(job.output, end='')
+
+    def reportFinished(self):
+        # Called before every prompt; finished jobs are shown once.
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.done.is_set() and not j.reported]
+        for job in finished:
+            self.report(job)
+            self.jobs.pop(job.id, None)
+
+    def getJob(self, params):
+        if len(params) < 1:
+            print('Missing job id')
+            return None
+        try:
+            job = self.jobs.get(int(params[0].lstrip('%')))
+        except ValueError:
+            job = None
+        if job is None:
+            print('No such job: ' + params[0])
+        return job
+
+    def exec_jobs(self, params):
+        rows = []
+        with self.lock:
+            for job in self.jobs.values():
+                rows.append([str(job.id), job.state, self.elapsed(job), job.text])
+        if len(rows) == 0:
+            print('No background jobs')
+        else:
+            printTable(rows, JobManager.job_headers)
+        return True
+
+    def exec_wait(self, params):
+        if len(params) == 0:
+            jobs = list(self.jobs.values())
+        else:
+            job = self.getJob(params)
+            if job is None:
+                return False
+            jobs = [job]
+        ok = True
+        for job in jobs:
+            job.done.wait()
+            ok = ok and job.ok
+            self.report(job)
+            self.jobs.pop(job.id, None)
+        return ok
+
+    def exec_cancel(self, params):
+        # A queued job is dropped. A running job cannot be stopped halfway
+        # through its REST calls; it is detached and its output discarded.
+        job = self.getJob(params)
+        if job is None:
+            return False
+        with self.lock:
+            if job.done.is_set():
+                print('Job ' + str(job.id) + ' already finished')
+                return False
+            running = job.state == 'running'
+            job.state = 'cancelled'
+        if not running and job.future.cancel():
+            job.done.set()
+        else:
+            print('Job ' + str(job.id) + ' is already running; requests it has sent are not undone')
+        print('[' + str(job.id) + '] Cancelled  ' + job.text)
+        job.reported = True
+        self.jobs.pop(job.id, None)
+        return True
+
+    def pending(self):
+        return [j for j in self.jobs.values() if not j.done.is_set()]
 
 class DBAdminShell:
     exitCommands = ["EXIT", "QUIT", "BYE"]
-    commands = ['create', 'change', 'delete', 'list', 'quit', 'help']
+    commands = ['create', 'change', 'delete', 'list', 'analyze', 'tail', 'export', 'plan', 'apply', 'top', 'collect',
+                'report', 'stats', 'jobs', 'wait', 'cancel', 'quit', 'help']
 
     def __init__(self, admin):
         self.admin = admin
+        self.jobs = JobManager(self)
 
     def printHelp(self):
-        print('list [db|shards] [<db uid>|<db name>]')
+        print('list [db|shards] [<db uid>|<db name>] [where <column><op><value>] [sort <column> [desc]]')
+        print('     [group by <column>] [limit <rows>] [--format table|jsonl|csv|tsv]')
+        print('list nodes [--format table|jsonl|csv|tsv]')
+        print('list replicaof [<db uid>|<db name>] [--format table|jsonl|csv|tsv]')
+        print('analyze placement [--format table|jsonl|csv|tsv]')
         print('create <db name> [memory <memory size in GB>] [ram <RAM size in GB for flash>] [port <port number>]')
         print('       [replication] [rack] [persist <persistence method>] [eviction <eviction policy>] [dbpass <database password>]')
         print('create <db name> json <json object>')
@@ -790,49 +3407,538 @@ class DBAdminShell:
         print('       [replicaof add <db uid>|<db name>|<uri> |start|stop|off]')
         print('       [persist <persistence method>] [eviction <eviction policy>] [dbpass <database password>]')
         print('change <db uid>|<db name> json <json object>')
+        print('       create and change also accept --wait [timeout in seconds] to wait until the database is active')
         print('delete <db uid>|<db name>')
+        print('change|delete all|where <field>=<value>|<field>!=<value>|<field>~<regex> ... [--dry-run] [--parallel <n>]')
+        print('       delete all|where asks for confirmation, or needs --yes outside the interactive shell')
+        print('export <spec file> | plan <spec file> [--format ' + '|'.join(output_formats) + '] | apply <spec file>')
+        print(DBTop.usage)
+        print('tail [db <db uid>|<db name>] [lines <count>] [interval <seconds>] [count <polls>] [--format table|jsonl]')
+        print('collect [file <path>] [interval <seconds>] [duration <seconds>] [downsample <samples>]')
+        print('report <path> [db <db uid>|<db name>] [--format ' + '|'.join(output_formats) + ']')
+        print('stats (connection reuse and per endpoint request latency)')
+        print('jobs | wait [<job id>] | cancel <job id>')
         print()
+        print('end a command with & to run it in the background')
         print('persistence methods: ' + ' '.join(DBAdmin.persist_options))
         print('eviction policies: ' + ' '.join(DBAdmin.eviction_options))
         print()
     
-    def execCommand(self, params):
+    def execCommand(self, params, newCommand=True):
+        try:
+            return self.dispatch(params, newCommand)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print('Error: ' + str(e))
+            return False
+        finally:
+            self.admin.endCommand()
+
+    def dispatch(self, params, newCommand=True):
+        if newCommand:
+            self.admin.beginCommand()
         command = params[0].upper()
         if command == 'LIST':
-            self.admin.exec_list(params[1:])
+            return self.admin.exec_list(params[1:])
+        elif command == 'ANALYZE':
+            return self.admin.exec_analyze(params[1:])
         elif command == 'CREATE':
-            self.admin.exec_create(params[1:])
+            return self.admin.exec_create(params[1:])
         elif command == 'DELETE':
-            self.admin.exec_delete(params[1:])
+            return self.admin.exec_delete(params[1:])
         elif command == 'CHANGE':
-            self.admin.exec_change(params[1:])
+            return self.admin.exec_change(params[1:])
+        elif command == 'EXPORT':
+            return self.admin.exec_export(params[1:])
+        elif command == 'PLAN':
+            return self.admin.exec_plan(params[1:])
+        elif command == 'APPLY':
+            return self.admin.exec_apply(params[1:])
+        elif command == 'TOP':
+            return self.admin.exec_top(params[1:])
+        elif command == 'TAIL':
+            return self.admin.exec_tail(params[1:])
+        elif command == 'COLLECT':
+            return self.admin.exec_collect(params[1:])
+        elif command == 'REPORT':
+            return self.admin.exec_report(params[1:])
+        elif command == 'STATS':
+            return self.admin.exec_stats(params[1:])
+        elif command == 'JOBS':
+            return self.jobs.exec_jobs(params[1:])
+        elif command == 'WAIT':
+            return self.jobs.exec_wait(params[1:])
+        elif command == 'CANCEL':
+            return self.jobs.exec_cancel(params[1:])
         else:
             self.printHelp()
+            return False
     
     def run(self):
-        if self.admin.dbNameToUid() == False:
-            print('Cannot connect to cluster')
-            return
-        
+        self.admin.local.interactive = True
         while True:
+            self.jobs.reportFinished()
             command = input("dbadmin>")
             if command.upper() in DBAdminShell.exitCommands:
                 break
-            
+
+            command = command.strip()
+            background = command.endswith('&')
+            if background:
+                command = command[:-1].strip()
             if command != '':
-                self.execCommand(shlex.split(command))
+                params = shlex.split(command)
+                if background and params[0].upper() in ['CREATE', 'CHANGE', 'DELETE', 'LIST']:
+                    self.jobs.submit(command, params)
+                elif background:
+                    print('Only create, change, delete and list can run in the background')
+                else:
+                    self.execCommand(params)
+
+        pending = self.jobs.pending()
+        if len(pending) > 0:
+            print('Waiting for ' + str(len(pending)) + ' background jobs...')
+            self.jobs.exec_wait([])
             
     
+class ClusterFleet:
+    # Runs list commands against every cluster of an inventory file at once.
+    # A cluster that does not answer within the timeout is reported and
+    # left out so it cannot hold back the others.
+    cluster_headers = ['Cluster']
+
+    def __init__(self, clusters, user, password, pool_size=10, timeout=10, output_format='table', lookahead=0):
+        self.clusters = clusters
+        self.timeout = timeout
+        self.output_format = output_format
+        self.lookahead = lookahead
+        self.connectors = []
+        for c in clusters:
+            self.connectors.append(HttpConnector(c['host'], c.get('port', 9443), c.get('user', user),
+                                                 c.get('password', password), pool_size, timeout))
+
+    @staticmethod
+    def loadInventory(path):
+        # The inventory is a json list of {"name", "host", ["port"], ["user"], ["password"]}.
+        with open(path) as f:
+            clusters = json.load(f)
+        for c in clusters:
+            if 'host' not in c:
+                raise ValueError('Missing host in cluster entry: ' + json.dumps(c))
+            c.setdefault('name', c['host'])
+        return clusters
+
+    def close(self):
+        for conn in self.connectors:
+            conn.close()
+
+    def fetchOne(self, i, param, results, errors):
+        try:
+            results[i] = self.connectors[i].get(param, True)
+            if results[i] is None:
+                errors[i] = 'request failed'
+        except requests.exceptions.RequestException as e:
+            errors[i] = str(e)
+
+    def fetchAll(self, param):
+        # Daemon threads rather than an executor, so a hung cluster does not
+        # keep the process alive after the others have been printed.
+        results = [None] * len(self.connectors)
+        errors = dict()
+        threads = []
+        for i in range(len(self.connectors)):
+            t = threading.Thread(target=self.fetchOne, args=(i, param, results, errors))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        deadline = time.time() + self.timeout
+        timed_out = dict()
+        for i in range(len(threads)):
+            threads[i].join(max(0, deadline - time.time()))
+            if threads[i].is_alive():
+                timed_out[i] = 'timed out after ' + str(self.timeout) + 's'
+        finished = [None if i in timed_out else results[i] for i in range(len(results))]
+        errors = dict((i, e) for i, e in list(errors.items()) if i not in timed_out)
+        errors.update(timed_out)
+        return finished, errors
+
+    def listAll(self, param, toRow, headers, fmt):
+        results, errors = self.fetchAll(param)
+        rows = ([self.clusters[i]['name']] + toRow(item)
+                for i in range(len(results)) if results[i] is not None for item in results[i])
+        printRows(rows, ClusterFleet.cluster_headers + headers, fmt, self.lookahead)
+        for i in sorted(errors.keys()):
+            print('Cluster ' + self.clusters[i]['name'] + ': ' + errors[i])
+        return len(errors) == 0
+
+    def exec_list(self, params):
+        params, fmt = formatParam(params, self.output_format)
+        if params is None:
+            return False
+        if len(params) > 1:
+            print('Listing a single database is not supported with --clusters')
+            return False
+        if len(params) == 0:
+            print("Databases:")
+            ok = self.listAll('bdbs', dbToRow, db_headers, fmt)
+            print("\nShards:")
+            return self.listAll('shards', shardToRow, shard_headers, fmt) and ok
+        if params[0] == 'db':
+            return self.listAll('bdbs', dbToRow, db_headers, fmt)
+        elif params[0] == 'shards':
+            return self.listAll('shards', shardToRow, shard_headers, fmt)
+        print('Invalid entity: ' + params[0])
+        return False
+
+    def execCommand(self, params):
+        if len(params) == 0 or params[0].upper() != 'LIST':
+            print('Only list is supported with --clusters')
+            return False
+        return self.exec_list(params[1:])
+
+class BatchJob(object):
+
+    def __init__(self, line, text):
+        self.line = line
+        self.text = text
+        self.params = []
+        self.key = None
+        self.barrier = False
+        self.ok = False
+        self.output = ''
+        self.elapsed = 0
+        self.done = threading.Event()
+
+class DBAdminBatch:
+    batch_commands = ['CREATE', 'CHANGE', 'DELETE', 'LIST']
+    summary_headers = ['Line', 'Command', 'Result', 'Time']
+
+    def __init__(self, shell, workers=8):
+        self.shell = shell
+        self.admin = shell.admin
+        self.workers = workers
+
+    def readLines(self, source):
+        lines = []
+        n = 0
+        for text in source:
+            n += 1
+            text = text.strip()
+            if text == '' or text.startswith('#'):
+                continue
+            lines.append(BatchJob(n, text))
+        return lines
+
+    def dbKey(self, param):
+        # Commands on the same database must keep file order, so names and
+        # uids are both reduced to the database name when it is known.
+        try:
+            uid = int(param)
+        except ValueError:
+            return param
+        name = self.admin.getDBName(uid)
+        if name is None:
+            return 'uid:' + param
+        return name
+
+    def prepare(self, job):
+        try:
+            job.params = shlex.split(job.text)
+        except ValueError as e:
+            job.output = 'Cannot parse command: ' + str(e) + '\n'
+            return False
+        command = job.params[0].upper()
+        if command not in DBAdminBatch.batch_commands:
+            job.output = 'Invalid command: ' + job.params[0] + '\n'
+            return False
+        if command == 'LIST':
+            if len(job.params) > 2:
+                job.key = self.dbKey(job.params[2])
+        elif len(job.params) > 1 and job.params[1] in ['all', 'where']:
+            # May touch any database, so it runs alone, after every line
+            # above it and before every line below it.
+            job.barrier = True
+        elif len(job.params) > 1:
+            job.key = self.dbKey(job.params[1])
+        return True
+
+    def runSegment(self, segment, executor):
+        # Lines of a segment run concurrently, one chain per database; the
+        # segment is done once all of them are.
+        chains = dict()
+        independent = []
+        for job in segment:
+            if job.done.is_set():
+                continue
+            if job.key is None:
+                independent.append([job])
+            else:
+                chains.setdefault(job.key, []).append(job)
+        for chain in list(chains.values()) + independent:
+            executor.submit(self.runChain, chain, executor)
+        for job in segment:
+            job.done.wait()
+            print('[' + str(job.line) + '] ' + job.text)
+            print(job.output, end='')
+
+    def runChain(self, chain, executor):
+        # A job that waits for its database hands the wait to the poller and
+        # frees the worker; the rest of its chain resumes on a worker once
+        # the database is ready.
+        router = sys.stdout
+        for i in range(len(chain)):
+            job = chain[i]
+            router.capture()
+            start = time.time()
+            self.admin.beginCommand()
+            self.admin.deferWaits(True)
+            try:
+                job.ok = self.shell.execCommand(job.params, False) == True
+            except Exception as e:
+                print('Error: ' + str(e))
+                job.ok = False
+            deferred = self.admin.deferWaits(False)
+            job.output = router.release()
+            if deferred is not None:
+                uid, timeout = deferred
+                rest = chain[i + 1:]
+                self.admin.poller.watch(uid, timeout, lambda state: executor.submit(
+                    self.resumeChain, job, uid, state, start, rest, executor))
+                return
+            job.elapsed = time.time() - start
+            job.done.set()
+
+    def resumeChain(self, job, uid, state, start, rest, executor):
+        router = sys.stdout
+        router.capture()
+        job.ok = self.admin.waitResult(uid, state) and job.ok
+        job.output += router.release()
+        job.elapsed = time.time() - start
+        job.done.set()
+        self.runChain(rest, executor)
+
+    def run(self, source):
+        jobs = self.readLines(source)
+        segments = [[]]
+        for job in jobs:
+            if not self.prepare(job):
+                job.done.set()
+                segments[-1].append(job)
+            elif job.barrier:
+                segments.append([job])
+                segments.append([])
+            else:
+                segments[-1].append(job)
+
+        stdout = sys.stdout
+        sys.stdout = OutputRouter(stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for segment in segments:
+                    self.runSegment(segment, executor)
+        finally:
+            sys.stdout = stdout
+
+        rows = []
+        failed = 0
+        for job in jobs:
+            if not job.ok:
+                failed += 1
+            rows.append([str(job.line), job.text, 'OK' if job.ok else 'FAILED', '%.2fs' % job.elapsed])
+        print('')
+        printTable(rows, DBAdminBatch.summary_headers)
+        print(str(len(jobs) - failed) + ' succeeded, ' + str(failed) + ' failed')
+        return failed == 0
+
+class SocketWriter:
+    # Output of a daemon command, sent to the client as json lines. Text is
+    # sent once 4KB are buffered or 100ms after the last send, so long
+    # listings and slow commands both stream.
+    flush_size = 4096
+    flush_interval = 0.1
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.parts = []
+        self.size = 0
+        self.last_send = time.time()
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= SocketWriter.flush_size or time.time() - self.last_send >= SocketWriter.flush_interval:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.size > 0:
+            self.send({'out': ''.join(self.parts)})
+            self.parts = []
+            self.size = 0
+        self.last_send = time.time()
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+
+    def getvalue(self):
+        return ''
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.daemon.handle(self.rfile, self.wfile)
+
+class DBAdminDaemon:
+    # Keeps the connector, its pool of TLS connections and the name index
+    # warm, and runs commands sent by thin clients over a unix socket, each
+    # on its own thread. The socket is only accessible to its owner.
+    rejected_commands = ['JOBS', 'WAIT', 'CANCEL', 'HELP'] + DBAdminShell.exitCommands
+
+    def __init__(self, shell, path):
+        self.shell = shell
+        self.path = path
+
+    def handle(self, rfile, wfile):
+        writer = SocketWriter(wfile)
+        ok = False
+        try:
+            request = json.loads(rfile.readline().decode())
+            argv = request['argv']
+            fmt = request.get('format')
+            lookahead = request.get('lookahead')
+            cwd = request.get('cwd')
+            if fmt is not None and fmt not in output_formats or lookahead is not None and int(lookahead) < 0:
+                raise ValueError()
+            if cwd is not None and not os.path.isabs(cwd):
+                raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            writer.send({'out': 'Invalid request\n', 'ok': False})
+            return
+        router = sys.stdout
+        router.capture(writer)
+        admin = self.shell.admin
+        admin.setOutput(fmt, lookahead)
+        admin.setWorkDir(cwd)
+        try:
+            if len(argv) == 0 or argv[0].upper() in DBAdminDaemon.rejected_commands:
+                print('Command not supported by the daemon: ' + ' '.join(argv))
+            else:
+                ok = self.shell.execCommand(argv) == True
+        except (IOError, OSError):
+            # The client went away.
+            pass
+        except Exception as e:
+            print('Error: ' + str(e))
+        finally:
+            admin.setOutput(None, None)
+            admin.setWorkDir(None)
+            router.release()
+        try:
+            writer.flush()
+            writer.send({'ok': ok})
+        except (IOError, OSError):
+            pass
+
+    def serve(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                print('Not a socket, refusing to replace ' + self.path)
+                return False
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                print('A daemon is already listening on ' + self.path)
+                return False
+            except (IOError, OSError):
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        if not isinstance(sys.stdout, OutputRouter):
+            sys.stdout = OutputRouter(sys.stdout)
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.path, DaemonHandler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        server.daemon = self
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print('Serving on ' + self.path)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+        return True
+
+def runClient(path, argv, options=None):
+    # Thin client: sends argv, with the --format and --lookahead given to the
+    # client and its working directory for file arguments, to a daemon and
+    # prints its output as it arrives.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError) as e:
+        print('Cannot connect to dbadmin daemon at ' + path + ': ' + str(e))
+        return None
+    request = dict(options or {})
+    request['argv'] = argv
+    request['cwd'] = os.getcwd()
+    ok = False
+    try:
+        sock.sendall((json.dumps(request) + '\n').encode())
+        for line in sock.makefile('rb'):
+            message = json.loads(line.decode())
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            if 'ok' in message:
+                ok = message['ok']
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+    return ok
+
+USAGE = ("dbadmin [-h <host>] [-p <port>] -u <user name> [-w password] [--pool-size <connections>]"
+         " [--cache-ttl <seconds>] [--index-ttl <seconds>] [-f <file>|-] [--workers <count>]"
+         " [--clusters <inventory file>] [--timeout <seconds>] [--connect-timeout <seconds>] [--deadline <seconds>]"
+         " [--retries <count>] [--format table|jsonl|csv|tsv]"
+         " [--lookahead <rows>] [--profile] [--trace <file>] [--no-cache] [--metadata-ttl <seconds>]"
+         " [--completion prefix|substring|fuzzy] [--socket <path>] [serve|command]")
+
 def main(argv):
     host = 'localhost'
     port = 9443
     user = ''
     passwd = ''
+    pool_size = 10
+    cache_ttl = 0
+    index_ttl = 300
+    batch_file = ''
+    workers = 8
+    clusters_file = ''
+    timeout = None
+    connect_timeout = None
+    deadline = 0
+    retries = None
+    output_format = 'table'
+    lookahead = 0
+    profile = False
+    trace_file = None
+    use_cache = True
+    metadata_ttl = 3600
+    completion = 'prefix'
+    socket_path = ''
     
     try:
-        opts, args = getopt.getopt(argv, 'h:p:u:w:')
+        opts, args = getopt.getopt(argv, 'h:p:u:w:f:', ['pool-size=', 'cache-ttl=', 'index-ttl=', 'workers=',
+                                                         'clusters=', 'timeout=', 'format=', 'lookahead=',
+                                                         'profile', 'trace=', 'no-cache', 'metadata-ttl=',
+                                                         'completion=', 'connect-timeout=', 'deadline=', 'retries=', 'socket='])
     except getopt.GetoptError:
-        print("dbadmin [-h <host>] [-p <port>] -u <user name> [-w password] [command]")
+        print(USAGE)
         sys.exit(2)
     
     for opt, arg in opts:
@@ -848,30 +3954,192 @@ def main(argv):
             user = arg
         elif opt == '-w':
             passwd = arg
+        elif opt == '--pool-size':
+            try:
+                pool_size = int(arg)
+            except ValueError:
+                print('Illegal pool size')
+                sys.exit(2)
+        elif opt == '--cache-ttl':
+            try:
+                cache_ttl = float(arg)
+            except ValueError:
+                print('Illegal cache ttl')
+                sys.exit(2)
+        elif opt == '--index-ttl':
+            try:
+                index_ttl = float(arg)
+            except ValueError:
+                print('Illegal index ttl')
+                sys.exit(2)
+        elif opt == '-f':
+            batch_file = arg
+        elif opt == '--workers':
+            try:
+                workers = int(arg)
+            except ValueError:
+                print('Illegal number of workers')
+                sys.exit(2)
+        elif opt == '--clusters':
+            clusters_file = arg
+        elif opt == '--timeout':
+            try:
+                timeout = float(arg)
+            except ValueError:
+                print('Illegal timeout')
+                sys.exit(2)
+        elif opt == '--connect-timeout':
+            try:
+                connect_timeout = float(arg)
+            except ValueError:
+                print('Illegal connect timeout')
+                sys.exit(2)
+        elif opt == '--deadline':
+            try:
+                deadline = float(arg)
+            except ValueError:
+                print('Illegal deadline')
+                sys.exit(2)
+        elif opt == '--retries':
+            try:
+                retries = int(arg)
+            except ValueError:
+                print('Illegal number of retries')
+                sys.exit(2)
+        elif opt == '--format':
+            if arg not in output_formats:
+                print('Illegal format, must be one of: ' + ' '.join(output_formats))
+                sys.exit(2)
+            output_format = arg
+        elif opt == '--lookahead':
+            try:
+                lookahead = int(arg)
+            except ValueError:
+                print('Illegal number of lookahead rows')
+                sys.exit(2)
+        elif opt == '--profile':
+            profile = True
+        elif opt == '--trace':
+            trace_file = arg
+        elif opt == '--no-cache':
+            use_cache = False
+        elif opt == '--metadata-ttl':
+            try:
+                metadata_ttl = float(arg)
+            except ValueError:
+                print('Illegal metadata ttl')
+                sys.exit(2)
+        elif opt == '--socket':
+            socket_path = arg
+        elif opt == '--completion':
+            if arg not in completion_modes:
+                print('Illegal completion mode, must be one of: ' + ' '.join(completion_modes))
+                sys.exit(2)
+            completion = arg
         else:
             print("Invalid parameter " + opt)
             sys.exit(2)
     
+    serve = len(args) == 1 and args[0] == 'serve'
+    if serve and socket_path == '':
+        print('Missing --socket for serve')
+        sys.exit(2)
+    if socket_path != '' and not serve:
+        if len(args) == 0:
+            print('Missing command for the dbadmin daemon')
+            sys.exit(2)
+        # The daemon was started with its own connection settings; only the
+        # output options are sent along with the command.
+        unsupported = [opt for opt, arg in opts if opt not in ['--socket', '--format', '--lookahead']]
+        if len(unsupported) > 0:
+            print('Not supported with --socket (set them when starting serve): ' + ' '.join(unsupported))
+            sys.exit(2)
+        options = dict()
+        if '--format' in [opt for opt, arg in opts]:
+            options['format'] = output_format
+        if '--lookahead' in [opt for opt, arg in opts]:
+            options['lookahead'] = lookahead
+        ok = runClient(socket_path, args, options)
+        sys.exit(2 if ok is None else 0 if ok else 1)
+
+    if clusters_file != '':
+        try:
+            clusters = ClusterFleet.loadInventory(clusters_file)
+        except (IOError, ValueError) as e:
+            print('Cannot read clusters inventory: ' + str(e))
+            sys.exit(2)
+        if user == '' and any('user' not in c for c in clusters):
+            print('Missing user name')
+            sys.exit(2)
+        if passwd == '' and any('password' not in c for c in clusters):
+            passwd = getpass.getpass()
+        fleet = ClusterFleet(clusters, user, passwd, pool_size, timeout if timeout is not None else 10,
+                             output_format, lookahead)
+        ok = fleet.execCommand(args if len(args) > 0 else ['list'])
+        fleet.close()
+        sys.exit(0 if ok else 1)
+
     if user == '':
         print('Missing user name')
-        print("dbadmin [-h <host>] [-p <port>] -u <user name> [-w password] [command]")
+        print(USAGE)
         sys.exit(2)
     
     if passwd == '':    
         passwd = getpass.getpass()
     
-    httpConnection = HttpConnector(host, port, user, passwd)
-    admin = DBAdmin(httpConnection)
-    if len(args) > 0:
+    try:
+        recorder = RequestRecorder(trace_file)
+    except IOError as e:
+        print('Cannot open trace file: ' + str(e))
+        sys.exit(2)
+    httpConnection = HttpConnector(host, port, user, passwd, pool_size, timeout, recorder, connect_timeout, deadline, retries)
+    admin = DBAdmin(httpConnection, cache_ttl, index_ttl, False)
+    if use_cache:
+        admin.useMetadataCache(MetadataCache(host, port, metadata_ttl))
+    admin.output_format = output_format
+    admin.lookahead = lookahead
+    if batch_file != '':
+        if admin.bootstrap() == False:
+            print('Cannot connect to cluster')
+            sys.exit(1)
+        admin.waitForIndex()
+        batch = DBAdminBatch(DBAdminShell(admin), workers)
+        if batch_file == '-':
+            ok = batch.run(sys.stdin)
+        else:
+            try:
+                with open(batch_file) as f:
+                    ok = batch.run(f)
+            except IOError as e:
+                print('Cannot read batch file: ' + str(e))
+                ok = False
+    elif serve:
+        if admin.bootstrap() == False:
+            print('Cannot connect to cluster')
+            sys.exit(1)
+        admin.waitForIndex()
+        if not DBAdminDaemon(DBAdminShell(admin), socket_path).serve():
+            httpConnection.close()
+            sys.exit(1)
+    elif len(args) > 0:
         DBAdminShell(admin).execCommand(args)
+    elif admin.bootstrap(trust_cache=True) == False:
+        print('Cannot connect to cluster')
     else:
-        readline.set_completer(SimpleCompleter(admin).complete)
+        loadReadline()
+        readline.set_completer(SimpleCompleter(admin, completion).complete)
         readline.parse_and_bind('tab: complete')
         readline.parse_and_bind('set editing-mode vi')
         readline.set_completer_delims(' \t\n')
-    
+
         DBAdminShell(admin).run()
         print("Goodbye")
+    if profile:
+        print("")
+        recorder.printReport()
+    httpConnection.close()
+    if batch_file != '':
+        sys.exit(0 if ok else 1)
     
 if __name__ == '__main__':
     main(sys.argv[1:])
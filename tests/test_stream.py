@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+# Tests of the incremental json array decoding behind HttpConnector.stream,
+# on canned bodies split at every chunk size and against the mock server.
+
+import sys, os, json, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+import dbadmin
+from mock_server import MockCluster, startServer
+
+USER = 'admin@example.com'
+PASSWORD = 'admin'
+
+class CannedResponse:
+    # Stands in for a streamed requests response: the body is handed out in
+    # chunks of a fixed size.
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.encoding = None
+        self.status_code = 200
+        self.closed = False
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i:i + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+class IterArrayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = dbadmin.HttpConnector('localhost', 9443, USER, PASSWORD)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def decode(self, body, chunk_size):
+        resp = CannedResponse(body, chunk_size)
+        try:
+            return list(self.conn.iterArray(resp, 'bdbs', 0, 0))
+        finally:
+            self.assertTrue(resp.closed)
+
+    def assertDecodes(self, value, body):
+        for chunk_size in list(range(1, 9)) + [64, len(body) + 1]:
+            self.assertEqual(self.decode(body, chunk_size), value, 'chunk size ' + str(chunk_size))
+
+    def test_empty(self):
+        self.assertDecodes([], b'[]')
+        self.assertDecodes([], b' [ ] \n')
+
+    def test_scalars(self):
+        # Numbers split by a chunk boundary ("2." of "2.5", "1" of "12")
+        # must not be decoded early.
+        value = [1, 2.5, -3e4, 12345678901234, True, False, None, 'a', 0]
+        self.assertDecodes(value, json.dumps(value).encode())
+        self.assertDecodes(value, json.dumps(value, separators=(',', ':')).encode())
+
+    def test_nested(self):
+        value = [{'uid': 1, 'name': 'db-1', 'sync_sources': [{'uri': 'redis://a:b@c:1'}]},
+                 {'uid': 2, 'name': 'a,]"}', 'endpoints': [[], {}]}]
+        self.assertDecodes(value, json.dumps(value, indent=2).encode())
+
+    def test_multibyte(self):
+        # Characters split across chunks are joined by the incremental decoder.
+        value = [{'name': 'ü€\U0001f600' * 10}] * 3
+        self.assertDecodes(value, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def test_malformed(self):
+        for body in [b'', b'   ', b'{"a": 1}', b'[1, 2', b'[1 2]', b'[{"a":', b'[1,]', b'[1]x', b'[1] [2]',
+                     b'[]]', b'["abc']:
+            for chunk_size in [1, 2, 64]:
+                with self.assertRaises(ValueError, msg=repr(body) + ' chunk size ' + str(chunk_size)):
+                    self.decode(body, chunk_size)
+
+    def test_trailing_whitespace(self):
+        self.assertDecodes([1], b'[1] \r\n\t ')
+
+class StreamTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cluster = MockCluster(dbs=20, shards_per_db=3)
+        cls.server = startServer(cls.cluster, user=USER, password=PASSWORD)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.conn = dbadmin.HttpConnector('localhost', self.server.server_port, USER, PASSWORD)
+        self.chunk = dbadmin.HttpConnector.stream_chunk
+
+    def tearDown(self):
+        dbadmin.HttpConnector.stream_chunk = self.chunk
+        self.conn.close()
+
+    def test_matches_get(self):
+        for param in ['bdbs', 'shards', 'bdbs/1/shards']:
+            for chunk in [7, 4096]:
+                dbadmin.HttpConnector.stream_chunk = chunk
+                self.assertEqual(list(self.conn.stream(param)), self.conn.get(param), param)
+
+    def test_recorded_once_consumed(self):
+        before = self.conn.recorder.endpoints.get(('GET', 'shards'))
+        self.assertIsNone(before)
+        rows = list(self.conn.stream('shards'))
+        entry = self.conn.recorder.endpoints.get(('GET', 'shards'))
+        self.assertIsNotNone(entry)
+        self.assertEqual(len(rows), 60)
+
+    def test_error_status(self):
+        self.assertIsNone(self.conn.stream('bdbs/999/shards', quiet=True))
+
+if __name__ == '__main__':
+    unittest.main()